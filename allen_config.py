@@ -44,6 +44,9 @@ class Allen_Brain_Observatory_Config():
         self.ccbp_exp_evals = os.path.join(
             self.project_directory,
             'experiment_evaluations')
+        self.build_cache_dir = os.path.join(  # Incremental rebuild cache
+            self.project_directory,
+            'build_cache')
         # self.deconv_model_dir = os.path.join(
         #     self.data_loc,
         #     'deconv_models')
@@ -78,6 +81,13 @@ class Allen_Brain_Observatory_Config():
         self.reshape_img_size_w = 31
         self.save_folder = 'DataForTrain/'
         self.db_ssh_forward = False
+        self.db_pool_min = 1  # Pooled psql connections per process
+        self.db_pool_max = 8
+        self.db_query_cache = False  # Cache RF/stimulus queries locally
+        self.db_query_cache_file = os.path.join(
+            self.build_cache_dir, 'query_cache.sqlite')
+        self.db_query_cache_ttl = 7 * 24 * 60 * 60  # Seconds (None = never)
+        self.db_itersize = 2000  # Rows per fetch for streamed queries
 
         # Template for cc_bp repo data loading
         self.multi_exps = 'multi_cell_exps'
@@ -1,10 +1,23 @@
 #!/usr/bin/env python
+import re
+import time
+import random
+import atexit
+import hashlib
+import uuid
+import weakref
+import functools
 import sshtunnel
 import argparse
+import threading
+import Queue
 import psycopg2
+import psycopg2.pool
 import psycopg2.extras
 import psycopg2.extensions
+import numpy as np
 import credentials
+import query_cache
 import os,sys,inspect
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parentdir = os.path.dirname(currentdir)
@@ -13,6 +26,256 @@ from allen_config import Allen_Brain_Observatory_Config
 sshtunnel.DAEMON = True  # Prevent hanging process due to forward thread
 main_config = Allen_Brain_Observatory_Config()
 
+# Process-wide connection pool and its (optional) long-lived SSH tunnel
+_pool = None
+_pool_pid = None
+_forward = None
+_pool_lock = threading.Lock()
+
+# Names of statements already PREPAREd on each pooled connection
+_prepared_statements = weakref.WeakKeyDictionary()
+_param_pattern = re.compile(r'%\((\w+)\)s')
+
+# Boolean stimulus flags of cell stim dicts (and the legacy cells table)
+STIMULUS_COLUMNS = [
+    'drifting_gratings',
+    'locally_sparse_noise',
+    'locally_sparse_noise_four_deg',
+    'locally_sparse_noise_eight_deg',
+    'natural_movie_one',
+    'natural_movie_two',
+    'natural_movie_three',
+    'natural_scenes',
+    'spontaneous',
+    'static_gratings'
+]
+
+# Columns written by populate_db_with_cell_stim/populate_db_with_rf
+CELL_STIMULI_COLUMNS = [
+    'cell_specimen_id',
+    'session',
+    'stimulus',
+    'npy_pointer'
+]
+RF_COLUMNS = [
+    'cell_specimen_id',
+    'lsn_name',
+    'experiment_container_id',
+    'found_on',
+    'found_off',
+    'alpha',
+    'number_of_shuffles',
+    'on_distance',
+    'on_area',
+    'on_overlap',
+    'on_height',
+    'on_center_x',
+    'on_center_y',
+    'on_width_x',
+    'on_width_y',
+    'on_rotation',
+    'off_distance',
+    'off_area',
+    'off_overlap',
+    'off_height',
+    'off_center_x',
+    'off_center_y',
+    'off_width_x',
+    'off_width_y',
+    'off_rotation',
+    'cre_line',
+    'structure',
+    'age',
+    'imaging_depth'
+]
+
+
+def get_pool():
+    """Return the process-wide connection pool, creating it on first use.
+
+    With db_ssh_forward a single SSH tunnel is opened for the pool and
+    reopened (along with the pool) if it drops."""
+    global _pool, _pool_pid, _forward
+    with _pool_lock:
+        if _pool is not None and _pool_pid != os.getpid():
+            # Forked child: never reuse (or close) the parent's sockets
+            _pool, _forward = None, None
+        if _forward is not None and not _forward.is_active:
+            print 'SSH tunnel dropped; reopening the connection pool.'
+            _close_pool()
+        if _pool is None or _pool.closed:
+            if main_config.db_ssh_forward:
+                _forward = sshtunnel.SSHTunnelForwarder(
+                    credentials.machine_credentials()['ssh_address'],
+                    ssh_username=credentials.machine_credentials()[
+                        'username'],
+                    ssh_password=credentials.machine_credentials()[
+                        'password'],
+                    remote_bind_address=('127.0.0.1', 5432))
+                _forward.start()
+                pgsql_port = _forward.local_bind_port
+            else:
+                _forward = None
+                pgsql_port = ''
+            _pool = psycopg2.pool.ThreadedConnectionPool(
+                main_config.db_pool_min,
+                main_config.db_pool_max,
+                **credentials.postgresql_connection(str(pgsql_port)))
+            _pool_pid = os.getpid()
+    return _pool
+
+
+def _close_pool():
+    """Close the pool and tunnel. Callers must hold _pool_lock."""
+    global _pool, _forward
+    if _pool_pid != os.getpid():
+        _pool, _forward = None, None
+    if _pool is not None and not _pool.closed:
+        _pool.closeall()
+    _pool = None
+    if _forward is not None:
+        _forward.close()
+    _forward = None
+
+
+def close_pool():
+    """Close all pooled connections and the SSH tunnel."""
+    with _pool_lock:
+        _close_pool()
+
+
+atexit.register(close_pool)
+
+
+def acquire_connection():
+    """Check out an autocommit connection from the pool (thread-safe)."""
+    pool = get_pool()
+    conn = pool.getconn()
+    if conn.closed:
+        # Replace connections that died while sitting in the pool
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    conn.set_isolation_level(
+        psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    return conn
+
+
+def release_connection(conn):
+    """Return a connection to the pool, discarding it if it is broken."""
+    with _pool_lock:
+        pool = _pool
+    if pool is None or pool.closed:
+        conn.close()
+        return
+    try:
+        pool.putconn(conn, close=bool(conn.closed))
+    except psycopg2.pool.PoolError:
+        # Connection belongs to a pool that has since been replaced
+        conn.close()
+
+
+def to_columns(rows, names):
+    """Build a dict of numpy arrays, one per column, from tuple rows.
+
+    Later duplicate column names win, as with RealDictCursor. Numeric
+    columns containing NULLs become float arrays with NaNs."""
+    if len(rows):
+        values = zip(*rows)
+    else:
+        values = [()] * len(names)
+    columns = {}
+    for name, column in zip(names, values):
+        column_array = np.array(column)
+        if column_array.dtype == object:
+            try:
+                column_array = np.array(column, dtype=np.float64)
+            except (TypeError, ValueError):
+                pass
+        columns[name] = column_array
+    return columns
+
+
+def dicts_to_columns(rows, names=None):
+    """Columnar (dict of numpy arrays) view of a list of row dicts."""
+    if names is None:
+        names = rows[0].keys() if len(rows) else []
+    return to_columns([tuple(r[n] for n in names) for r in rows], names)
+
+
+def cell_stimuli_rows(cell_stim_dicts):
+    """Expand cell stim dicts (one flag per stimulus) into cell_stimuli rows."""
+    for d in cell_stim_dicts:
+        for stimulus in STIMULUS_COLUMNS:
+            if d.get(stimulus, False):
+                yield {
+                    'cell_specimen_id': d['cell_specimen_id'],
+                    'session': d['session'],
+                    'stimulus': stimulus,
+                    'npy_pointer': d['cell_output_npy']
+                }
+
+
+class copy_stream(object):
+    """File-like view of an iterable of row dicts in COPY text format.
+
+    Rows are pulled from the iterable as copy_expert reads, so generators
+    can be streamed into the DB without building a list."""
+
+    def __init__(self, rows, columns):
+        self.lines = (self.format_row(row, columns) for row in rows)
+        self.buffer = ''
+
+    def format_value(self, value):
+        """Render one value as a COPY text field."""
+        if isinstance(value, np.generic):
+            value = value.item()  # Native python types render correctly
+        if value is None:
+            return '\\N'
+        if isinstance(value, bool):
+            return 't' if value else 'f'
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        elif isinstance(value, float):
+            # repr keeps full precision; postgres spells infinity out
+            if np.isinf(value):
+                value = 'Infinity' if value > 0 else '-Infinity'
+            else:
+                value = repr(value)
+        elif not isinstance(value, str):
+            value = str(value)  # No 'L' suffix on longs
+        return value.replace('\\', '\\\\').replace(
+            '\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+    def format_row(self, row, columns):
+        """Render one row dict as a COPY text line."""
+        return '\t'.join(
+            self.format_value(row.get(c, None)) for c in columns) + '\n'
+
+    def read(self, size=-1):
+        """Return up to size bytes of COPY data."""
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.lines)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        """Return the next COPY line."""
+        if '\n' not in self.buffer:
+            try:
+                self.buffer += next(self.lines)
+            except StopIteration:
+                pass
+        end = self.buffer.find('\n') + 1 or len(self.buffer)
+        if size >= 0:
+            end = min(end, size)
+        data, self.buffer = self.buffer[:end], self.buffer[end:]
+        return data
+
 
 class data_db(object):
     def __init__(self, config):
@@ -23,23 +286,7 @@ class data_db(object):
             setattr(self, k, v)
 
     def __enter__(self):
-        if main_config.db_ssh_forward:
-            forward = sshtunnel.SSHTunnelForwarder(
-                credentials.machine_credentials()['ssh_address'],
-                ssh_username=credentials.machine_credentials()['username'],
-                ssh_password=credentials.machine_credentials()['password'],
-                remote_bind_address=('127.0.0.1', 5432))
-            forward.start()
-            self.forward = forward
-            self.pgsql_port = forward.local_bind_port
-        else:
-            self.forward = None
-            self.pgsql_port = ''
-        pgsql_string = credentials.postgresql_connection(str(self.pgsql_port))
-        self.pgsql_string = pgsql_string
-        self.conn = psycopg2.connect(**pgsql_string)
-        self.conn.set_isolation_level(
-            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        self.conn = acquire_connection()
         self.cur = self.conn.cursor(
             cursor_factory=psycopg2.extras.RealDictCursor)
         return self
@@ -50,14 +297,17 @@ class data_db(object):
             self.close_db(commit=False)
         else:
             self.close_db()
-        if main_config.db_ssh_forward:
-            self.forward.close()
-        return self
+        return False  # Let exceptions propagate to the caller
 
     def close_db(self, commit=True):
-        self.conn.commit()
+        """Close the cursor and hand the connection back to the pool."""
+        if not self.conn.closed:
+            if commit:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
         self.cur.close()
-        self.conn.close()
+        release_connection(self.conn)
 
     def return_status(
             self,
@@ -88,59 +338,80 @@ class data_db(object):
                 if len(t):
                     self.cur.execute(t)
 
-    def populate_db_with_cell_stim(self, namedict):
+    def bulk_insert(self, table, columns, rows):
+        """
+        COPY rows (an iterable of dicts) into a temp table, then merge them
+        into table, skipping rows that violate its unique constraints.
+        Returns the number of new rows.
+        """
+        staging = 'staging_%s' % table
+        self.cur.execute('BEGIN')
+        try:
+            self.cur.execute(
+                'CREATE TEMP TABLE %s ON COMMIT DROP AS '
+                'SELECT %s FROM %s WITH NO DATA' % (
+                    staging, ', '.join(columns), table))
+            self.cur.copy_expert(
+                'COPY %s (%s) FROM STDIN' % (staging, ', '.join(columns)),
+                copy_stream(rows, columns))
+            self.cur.execute(
+                'INSERT INTO %s (%s) SELECT %s FROM %s '
+                'ON CONFLICT DO NOTHING' % (
+                    table,
+                    ', '.join(columns),
+                    ', '.join(columns),
+                    staging))
+            inserted = self.cur.rowcount
+            self.cur.execute('COMMIT')
+        except Exception:
+            self.cur.execute('ROLLBACK')
+            raise
+        if self.status_message:
+            print 'Bulk inserted %s rows into %s.' % (inserted, table)
+        return inserted
+
+    def populate_db_with_cell_stim(self, namedict, bulk=False):
         """
         Add cell stim info to the db.
         ::
         experiment_name: name of experiment to add
         parent_experiment: linking a child (e.g. clickme) -> parent (ILSVRC12)
+        bulk: stream namedict (any iterable) through COPY instead.
         """
+        rows = cell_stimuli_rows(namedict)
+        if bulk:
+            return self.bulk_insert('cell_stimuli', CELL_STIMULI_COLUMNS, rows)
         self.cur.executemany(
             """
-            INSERT INTO cells
+            INSERT INTO cell_stimuli
             (
             cell_specimen_id,
             session,
-            drifting_gratings,
-            locally_sparse_noise,
-            locally_sparse_noise_four_deg,
-            locally_sparse_noise_eight_deg,
-            natural_movie_one,
-            natural_movie_two,
-            natural_movie_three,
-            natural_scenes,
-            spontaneous,
-            static_gratings,
-            cell_output_npy
+            stimulus,
+            npy_pointer
             )
             VALUES
             (
             %(cell_specimen_id)s,
             %(session)s,
-            %(drifting_gratings)s,
-            %(locally_sparse_noise)s,
-            %(locally_sparse_noise_four_deg)s,
-            %(locally_sparse_noise_eight_deg)s,
-            %(natural_movie_one)s,
-            %(natural_movie_two)s,
-            %(natural_movie_three)s,
-            %(natural_scenes)s,
-            %(spontaneous)s,
-            %(static_gratings)s,
-            %(cell_output_npy)s
+            %(stimulus)s,
+            %(npy_pointer)s
             )
             """,
-            namedict)
+            rows)
         if self.status_message:
             self.return_status('INSERT')
 
-    def populate_db_with_rf(self, namedict):
+    def populate_db_with_rf(self, namedict, bulk=False):
         """
         Add cell RF info to the db.
         ::
         experiment_name: name of experiment to add
         parent_experiment: linking a child (e.g. clickme) -> parent (ILSVRC12)
+        bulk: stream namedict (any iterable) through COPY instead.
         """
+        if bulk:
+            return self.bulk_insert('rf', RF_COLUMNS, namedict)
         self.cur.executemany(
             """
             INSERT INTO rf
@@ -212,150 +483,376 @@ class data_db(object):
         if self.status_message:
             self.return_status('INSERT')
 
-    def select_cells_by_rf_coor(self, namedict):
+    def execute_prepared(self, sql, params, cur=None):
+        """
+        Execute a %(name)s-style query as a server-side prepared statement.
+        Statements are named by a hash of their SQL and prepared once per
+        connection, so repeat calls skip parsing and planning.
+        """
+        if cur is None:
+            cur = self.cur
+        names = []
+
+        def placeholder(match):
+            if match.group(1) not in names:
+                names.append(match.group(1))
+            return '$%s' % (names.index(match.group(1)) + 1)
+
+        statement = _param_pattern.sub(placeholder, sql)
+        name = 'data_db_%s' % hashlib.md5(statement).hexdigest()
+        prepared = _prepared_statements.setdefault(self.conn, set())
+        if name not in prepared:
+            cur.execute('PREPARE %s AS %s' % (name, statement))
+            prepared.add(name)
+        if len(names):
+            cur.execute(
+                'EXECUTE %s (%s)' % (name, ', '.join(['%s'] * len(names))),
+                [params[n] for n in names])
+        else:
+            cur.execute('EXECUTE %s' % name)
+
+    def fetch_prepared(self, sql, params, columnar=False):
+        """
+        Run execute_prepared and fetch every row as a dict, or (columnar)
+        as a dict of numpy arrays built straight from tuple rows.
+        """
+        if not columnar:
+            self.execute_prepared(sql, params)
+            return self.cur.fetchall()
+        cur = self.conn.cursor()
+        try:
+            self.execute_prepared(sql, params, cur=cur)
+            return to_columns(
+                cur.fetchall(),
+                [c[0] for c in cur.description])
+        finally:
+            cur.close()
+
+    def rf_range_clause(self):
+        """
+        WHERE clause for RF centers in [x_min, x_max) x [y_min, y_max).
+        The redundant box test lets the planner use the GiST point index.
+        """
+        return """
+            on_center_x >= %(x_min)s::float8 and
+            on_center_x < %(x_max)s::float8 and
+            on_center_y >= %(y_min)s::float8 and
+            on_center_y < %(y_max)s::float8 and
+            point(on_center_x, on_center_y) <@ box(
+                point(%(x_min)s::float8, %(y_min)s::float8),
+                point(%(x_max)s::float8, %(y_max)s::float8))
+            """
+
+    def select_cells_by_rf_coor(self, namedict, columnar=False):
         """
         Select cells by rf coordinates.
         """
-        self.cur.execute(
+        rows = self.fetch_prepared(
             """
             SELECT * FROM rf
             WHERE
-            on_center_x >= %s and
-            on_center_x < %s and
-            on_center_y >= %s and
-            on_center_y < %s
+            %s
             """
-            %
-            (
-                namedict['x_min'],
-                namedict['x_max'],
-                namedict['y_min'],
-                namedict['y_max'])
-            )
+            % self.rf_range_clause(),
+            namedict,
+            columnar)
         if self.status_message:
             self.return_status('INSERT')
-        return self.cur.fetchall()
+        return rows
 
-    def gather_data_by_rf_coor(self, namedict):
+    def gather_data_by_rf_coor(self, namedict, columnar=False):
         """
         Select cells by rf coordinates.
         """
-        eq = ''
-        if 'cre_line' in namedict:
-            eq += " and lower(cre_line) LIKE '%%%s%%'"  % namedict['cre_line'].lower()
-        if 'structure' in namedict:
-            eq += " and lower(structure)='%s'" % namedict['structure'].lower()
-        if 'imaging_depth' in namedict:
-            eq += " and imaging_depth=%s" % namedict['imaging_depth']
-
-        self.cur.execute(
+        eq, params = self.rf_filter_clause(namedict)
+        join, join_params = self.cell_stimuli_join()
+        params.update(join_params)
+        params.update(namedict['rf_coordinate_range'])
+        rows = self.fetch_prepared(
             """
-            SELECT DISTINCT ON (cells.cell_specimen_id) * FROM rf
-            INNER JOIN cells on cells.cell_specimen_id=rf.cell_specimen_id
+            SELECT DISTINCT ON (rf.cell_specimen_id) * FROM rf
+            %s
             WHERE
-            on_center_x >= %s and
-            on_center_x < %s and
-            on_center_y >= %s and
-            on_center_y < %s
+            %s
             %s
             """
             %
             (
-                namedict['rf_coordinate_range']['x_min'],
-                namedict['rf_coordinate_range']['x_max'],
-                namedict['rf_coordinate_range']['y_min'],
-                namedict['rf_coordinate_range']['y_max'],
-                eq)
-            )
+                join,
+                self.rf_range_clause(),
+                eq),
+            params,
+            columnar)
         if self.status_message:
             self.return_status('INSERT')
-        return self.cur.fetchall()
-
-    def proc_stim_query(
-            self,
-            stim_string,
-            stim_query,
-            logical=' or ',
-            column=None,
-            sub_query=None):
-        if len(stim_string) > 0:
-            stim_string += logical
-        if column is not None:
-            stim_query = '%s=\'' % column + stim_query + '\''
-        if sub_query is not None:
-            stim_query = '(%s and (%s))' % (stim_query, sub_query)
-        stim_string += stim_query
-        return stim_string
+        return rows
 
-    def gather_data_by_rf_coor_and_stim(
-            self,
-            namedict,
-            stimuli_filter=None,
-            session_filter=None):
+    def rf_filter_clause(self, namedict):
         """
-        Select cells by rf coordinates.
+        Build the cre line/structure/depth filters.
+        Returns the clause and a dict of its parameters.
         """
-        eq = ''
+        eq, params = '', {}
         if 'cre_line' in namedict:
-            eq += " and lower(cre_line) LIKE '%%%s%%'"  % namedict['cre_line'].lower()
-        if 'structure' in namedict: 
-            eq += " and lower(structure)='%s'" % namedict['structure'].lower()
+            eq += ' and lower(cre_line) LIKE %(cre_line)s::text'
+            params['cre_line'] = '%%%s%%' % namedict['cre_line'].lower()
+        if 'structure' in namedict:
+            eq += ' and lower(structure)=%(structure)s::text'
+            params['structure'] = namedict['structure'].lower()
         if 'imaging_depth' in namedict:
-            eq += " and imaging_depth=%s" % namedict['imaging_depth']
+            eq += ' and imaging_depth=%(imaging_depth)s::int'
+            params['imaging_depth'] = namedict['imaging_depth']
+        return eq, params
 
-        # Create stimulus filter
-        stim_string = ''
+    def cell_stimuli_join(self, stimuli_filter=None, session_filter=None):
+        """
+        Join rf to the distinct cell/session data files in cell_stimuli,
+        filtered by indexed stimulus and session lookups.
+        Returns the join and a dict of its parameters.
+        """
+        where, params = [], {}
         if stimuli_filter is not None:
-            for stim_query in stimuli_filter:
-                stim_string = self.proc_stim_query(
-                    stim_string,
-                    stim_query)
-            if len(stim_string) > 0 and session_filter is None:
-                stim_string = ' and ' + stim_string
-            print 'Querying stimuli by: %s.' % stim_string
-
-        # Create session filter
+            print 'Querying stimuli by: %s.' % stimuli_filter
+            unknown = [
+                s for s in stimuli_filter if s not in STIMULUS_COLUMNS]
+            if len(unknown):
+                raise ValueError(
+                    'Unknown stimuli %s. Expected any of %s.' % (
+                        unknown, STIMULUS_COLUMNS))
+            where += ['stimulus = ANY(%(stimuli)s::text[])']
+            params['stimuli'] = list(stimuli_filter)
         if session_filter is not None:
-            session_string = ''
-            for session_query in session_filter:
-                session_string = self.proc_stim_query(
-                    session_string,
-                    session_query,
-                    sub_query=stim_string,
-                    column='session')
-            if len(session_string) > 0:
-                session_string = ' and (' + session_string
-                print 'Querying session by: %s.' % session_string
-                stim_string = session_string
-                stim_string += ')'
+            print 'Querying session by: %s.' % session_filter
+            where += ['session = ANY(%(sessions)s::text[])']
+            params['sessions'] = list(session_filter)
+        if len(where):
+            where = 'WHERE %s' % ' and '.join(where)
         else:
-            stim_string = ' and (%s)' % stim_string.split('and ')[-1]
+            where = ''
+        return """
+            INNER JOIN (
+                SELECT DISTINCT
+                    cell_specimen_id,
+                    session,
+                    npy_pointer AS cell_output_npy
+                FROM cell_stimuli
+                %s
+            ) AS stims on stims.cell_specimen_id=rf.cell_specimen_id
+            """ % where, params
 
-        # Query DB -- Note the distinct flag on inner join!
-        self.cur.execute(
-            """
+    def rf_stim_query(
+            self,
+            namedict,
+            stimuli_filter=None,
+            session_filter=None):
+        """
+        Build the SQL and parameters for gather_data_by_rf_coor_and_stim.
+        """
+        eq, params = self.rf_filter_clause(namedict)
+        join, join_params = self.cell_stimuli_join(
+            stimuli_filter,
+            session_filter)
+        params.update(join_params)
+        params.update(namedict['rf_coordinate_range'])
+        return """
             SELECT * FROM rf
-            INNER JOIN cells on cells.cell_specimen_id=rf.cell_specimen_id
+            %s
             WHERE
-            on_center_x >= %s and
-            on_center_x < %s and
-            on_center_y >= %s and
-            on_center_y < %s
             %s
             %s
-            """
-            %
-            (
-                namedict['rf_coordinate_range']['x_min'],
-                namedict['rf_coordinate_range']['x_max'],
-                namedict['rf_coordinate_range']['y_min'],
-                namedict['rf_coordinate_range']['y_max'],
-                eq,
-                stim_string)
-            )
+            """ % (join, self.rf_range_clause(), eq), params
+
+    def rf_grid_stim_query(
+            self,
+            namedict,
+            stimuli_filter=None,
+            session_filter=None):
+        """
+        Build the SQL and parameters for gather_data_by_rf_grid_and_stim.
+        Tile bounds are passed as arrays and unnested into a tile table.
+        """
+        eq, params = self.rf_filter_clause(namedict)
+        join, join_params = self.cell_stimuli_join(
+            stimuli_filter,
+            session_filter)
+        params.update(join_params)
+        return """
+            SELECT tiles.tile_idx, rf.*, stims.* FROM unnest(
+                %%(x_min)s::float8[],
+                %%(x_max)s::float8[],
+                %%(y_min)s::float8[],
+                %%(y_max)s::float8[])
+                WITH ORDINALITY AS tiles(x_min, x_max, y_min, y_max, tile_idx)
+            INNER JOIN rf on
+                on_center_x >= tiles.x_min and
+                on_center_x < tiles.x_max and
+                on_center_y >= tiles.y_min and
+                on_center_y < tiles.y_max and
+                point(on_center_x, on_center_y) <@ box(
+                    point(tiles.x_min, tiles.y_min),
+                    point(tiles.x_max, tiles.y_max))
+            %s
+            WHERE TRUE
+            %s
+            ORDER BY tiles.tile_idx
+            """ % (join, eq), params
+
+    def gather_data_by_rf_coor_and_stim(
+            self,
+            namedict,
+            stimuli_filter=None,
+            session_filter=None,
+            columnar=False):
+        """
+        Select cells by rf coordinates.
+        """
+        sql, params = self.rf_stim_query(
+            namedict,
+            stimuli_filter,
+            session_filter)
+        rows = self.fetch_prepared(sql, params, columnar)
         if self.status_message:
             self.return_status('INSERT')
-        return self.cur.fetchall()
+        return rows
+
+    def gather_data_by_rf_grid_and_stim(
+            self,
+            rfs,
+            stimuli_filter=None,
+            session_filter=None,
+            columnar=False):
+        """
+        Select cells for a list of rf tiles in one round trip per filter.
+        Tiles sharing cre_line/structure/imaging_depth are queried
+        together and the rows are split back out per tile.
+        """
+        tile_data = [[] for _ in rfs]
+        filter_groups = {}
+        for idx, it_rf in enumerate(rfs):
+            filter_key = tuple(
+                (k, v) for k, v in sorted(it_rf.items())
+                if k != 'rf_coordinate_range')
+            filter_groups.setdefault(filter_key, []).append(idx)
+        for filter_key, tile_idxs in filter_groups.iteritems():
+            sql, params = self.rf_grid_stim_query(
+                dict(filter_key),
+                stimuli_filter,
+                session_filter)
+            for k in ['x_min', 'x_max', 'y_min', 'y_max']:
+                params[k] = [
+                    rfs[idx]['rf_coordinate_range'][k] for idx in tile_idxs]
+            rows = self.fetch_prepared(sql, params, columnar)
+            if columnar:
+                # Rows are sorted by tile, so split the columns at tile edges
+                tile_ids = rows.pop('tile_idx')
+                edges = np.searchsorted(
+                    tile_ids,
+                    np.arange(1, len(tile_idxs) + 2))
+                for it, idx in enumerate(tile_idxs):
+                    tile_data[idx] = dict(
+                        (k, v[edges[it]:edges[it + 1]])
+                        for k, v in rows.iteritems())
+                continue
+            for row in rows:
+                # ORDINALITY is 1-indexed
+                tile_data[tile_idxs[row.pop('tile_idx') - 1]] += [row]
+        if self.status_message:
+            self.return_status('SELECT')
+        return tile_data
+
+    def stream_query(self, sql, params=None, itersize=None, row_format='dict'):
+        """
+        Lazily fetch a query through a named server-side cursor.
+        ::
+        itersize: rows per round trip (default main_config.db_itersize).
+        row_format: 'dict' (plain dicts), 'tuple' (rows in column order)
+            or 'records' (numpy record arrays of up to itersize rows).
+        """
+        if itersize is None:
+            itersize = main_config.db_itersize
+        # A held cursor is materialized in full on autocommit, so stream
+        # through a plain named cursor inside an explicit transaction
+        self.conn.set_isolation_level(
+            psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+        cur = self.conn.cursor('data_db_stream_%s' % uuid.uuid4().hex)
+        cur.itersize = itersize
+        committed = False
+        try:
+            cur.execute(sql, params)
+            while True:
+                rows = cur.fetchmany(itersize)
+                if not len(rows):
+                    break
+                names = [c[0] for c in cur.description]
+                if row_format == 'tuple':
+                    for row in rows:
+                        yield row
+                    continue
+                # Later duplicate columns win, as with RealDictCursor
+                keep = [
+                    idx for idx, name in enumerate(names)
+                    if name not in names[idx + 1:]]
+                if row_format == 'records':
+                    yield np.rec.fromrecords(
+                        [tuple(row[idx] for idx in keep) for row in rows],
+                        names=[names[idx] for idx in keep])
+                elif row_format == 'dict':
+                    for row in rows:
+                        yield dict((names[idx], row[idx]) for idx in keep)
+                else:
+                    raise RuntimeError(
+                        'Unrecognized row_format: %s' % row_format)
+            committed = True
+        except GeneratorExit:
+            # The consumer stopped early; nothing was written
+            committed = True
+            raise
+        finally:
+            if not self.conn.closed:
+                if committed:
+                    cur.close()
+                    self.conn.commit()
+                else:
+                    # Rolling back also drops the server-side cursor
+                    self.conn.rollback()
+                self.conn.set_isolation_level(
+                    psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+
+    def stream_data_by_rf_coor_and_stim(
+            self,
+            namedict,
+            stimuli_filter=None,
+            session_filter=None,
+            itersize=None,
+            row_format='dict'):
+        """
+        Streaming version of gather_data_by_rf_coor_and_stim.
+        """
+        sql, params = self.rf_stim_query(
+            namedict,
+            stimuli_filter,
+            session_filter)
+        return self.stream_query(sql, params, itersize, row_format)
+
+    def explain(self, query, params=None):
+        """
+        Run EXPLAIN ANALYZE on a query and return its JSON plan.
+        """
+        self.cur.execute(
+            'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) %s' % query,
+            params)
+        return self.cur.fetchone()['QUERY PLAN'][0]
+
+    def migrate_db(self, migration_dir='data_db/migrations'):
+        """Apply every migration file (in name order) to the DB."""
+        for migration in sorted(os.listdir(migration_dir)):
+            print 'Applying migration %s.' % migration
+            statements = open(
+                os.path.join(migration_dir, migration)).read().splitlines()
+            for s in statements:
+                t = s.strip()
+                if len(t):
+                    self.cur.execute(t)
 
 
 def initialize_database():
@@ -366,6 +863,188 @@ def initialize_database():
         db_conn.return_status('CREATE')
 
 
+def migrate_database():
+    """Bring an existing psql database up to date with the migrations."""
+    config = credentials.postgresql_connection()
+    with data_db(config) as db_conn:
+        db_conn.migrate_db()
+
+
+def plan_nodes(plan):
+    """Flatten an EXPLAIN JSON plan into a list of its nodes."""
+    nodes = [plan]
+    for sub_plan in plan.get('Plans', []):
+        nodes += plan_nodes(sub_plan)
+    return nodes
+
+
+def explain_grid_queries(rfs, stimuli=None, sessions=None):
+    """EXPLAIN ANALYZE RF/stimulus queries and report the indexes used."""
+    config = credentials.postgresql_connection()
+    summaries = []
+    with data_db(config) as db_conn:
+        for it_rf in rfs:
+            plan = db_conn.explain(
+                *db_conn.rf_stim_query(it_rf, stimuli, sessions))
+            nodes = plan_nodes(plan['Plan'])
+            summary = {
+                'rf_coordinate_range': it_rf['rf_coordinate_range'],
+                'indexes': sorted(set(
+                    n['Index Name'] for n in nodes if 'Index Name' in n)),
+                'seq_scans': sorted(set(
+                    n['Relation Name'] for n in nodes
+                    if n['Node Type'] == 'Seq Scan')),
+                'planning_ms': plan['Planning Time'],
+                'execution_ms': plan['Execution Time'],
+                'rows': plan['Plan']['Actual Rows'],
+            }
+            print '%(rf_coordinate_range)s: %(rows)s rows in ' \
+                '%(execution_ms).2fms (plan %(planning_ms).2fms) | ' \
+                'indexes: %(indexes)s | seq scans: %(seq_scans)s' % summary
+            summaries += [summary]
+    return summaries
+
+
+def default_grid_queries(width=20, stride=10):
+    """Tile the LSN visual field for benchmarking grid queries."""
+    visual_space = main_config.LSN_size_in_deg
+    queries = []
+    for x1 in range(0, int(visual_space['width']), stride):
+        for y1 in range(0, int(visual_space['height']), stride):
+            queries += [{
+                'rf_coordinate_range': {
+                    'x_min': x1,
+                    'x_max': x1 + width,
+                    'y_min': y1,
+                    'y_max': y1 + width,
+                }
+            }]
+    return queries
+
+
+def prefetch(jobs, depth=1):
+    """Run zero-argument query jobs ahead of the consumer in threads.
+
+    Yields each job's result in order while up to depth later jobs run in
+    the background on their own pooled connections, so DB latency
+    overlaps with whatever the caller does between results. A job's
+    exception is re-raised when its result is reached. depth=0 runs jobs
+    inline."""
+    jobs = iter(jobs)
+    if depth <= 0:
+        for job in jobs:
+            yield job()
+        return
+
+    def run(job, result):
+        try:
+            result.put((True, job()))
+        except Exception:
+            result.put((False, sys.exc_info()))
+
+    pending = []
+    for job in jobs:
+        result = Queue.Queue(maxsize=1)
+        worker = threading.Thread(target=run, args=(job, result))
+        worker.daemon = True
+        worker.start()
+        pending += [result]
+        if len(pending) > depth:
+            ok, value = pending.pop(0).get()
+            if not ok:
+                raise value[0], value[1], value[2]
+            yield value
+    for result in pending:
+        ok, value = result.get()
+        if not ok:
+            raise value[0], value[1], value[2]
+        yield value
+
+
+def check_prefetch(n_jobs=20, depth=4, max_sleep=0.05):
+    """Sanity check prefetch with fake jobs that sleep random amounts.
+
+    Later jobs often finish first, so this checks that results still come
+    back in job order at every depth, and that a failing job's exception
+    reaches the consumer at that job's position. Needs no database."""
+    def fake_job(i, fail=False):
+        def job():
+            time.sleep(random.uniform(0, max_sleep))
+            if fail:
+                raise KeyError(i)
+            return i
+        return job
+
+    for it_depth in range(depth + 1):
+        results = list(prefetch(
+            [fake_job(i) for i in range(n_jobs)],
+            depth=it_depth))
+        assert results == range(n_jobs), (
+            'Out of order at depth %s: %s' % (it_depth, results))
+        fail_at = n_jobs // 2
+        results = []
+        try:
+            for result in prefetch(
+                    [fake_job(i, fail=i == fail_at) for i in range(n_jobs)],
+                    depth=it_depth):
+                results += [result]
+        except KeyError as e:
+            assert e.args == (fail_at,), 'Wrong exception: %s' % e
+        else:
+            raise AssertionError(
+                'Exception was swallowed at depth %s.' % it_depth)
+        assert results == range(fail_at), (
+            'Results past the failure at depth %s: %s' % (it_depth, results))
+    print 'prefetch delivered in order and propagated errors ' \
+        'at depths 0-%s.' % depth
+
+
+def plain_rows(rows):
+    """Convert (nested lists of) cursor rows into plain dicts."""
+    if isinstance(rows, list):
+        return [plain_rows(r) for r in rows]
+    return dict(rows)
+
+
+def db_version():
+    """Hash of the DB schema and migration files, for versioning caches."""
+    migration_dir = os.path.join(currentdir, 'migrations')
+    schema_files = [os.path.join(currentdir, 'db_schema.txt')] + [
+        os.path.join(migration_dir, f)
+        for f in sorted(os.listdir(migration_dir))]
+    return query_cache.schema_version(schema_files)
+
+
+def open_query_cache():
+    """Open the local query cache, versioned by the DB schema files."""
+    return query_cache.query_cache(
+        cache_file=main_config.db_query_cache_file,
+        ttl=main_config.db_query_cache_ttl,
+        version=db_version())
+
+
+def cache_query(fn):
+    """Serve a query function from the local cache when it is enabled."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not main_config.db_query_cache:
+            return fn(*args, **kwargs)
+        cache = open_query_cache()
+        try:
+            key = query_cache.query_key(fn.__name__, *args, **kwargs)
+            rows = cache.get(key)
+            if rows is None:
+                rows = plain_rows(fn(*args, **kwargs))
+                cache.set(key, rows)
+            else:
+                print 'Loaded %s from the query cache.' % fn.__name__
+        finally:
+            cache.close()
+        return rows
+    return wrapper
+
+
+@cache_query
 def get_cells_by_rf(list_of_dicts):
     """Query cells by their RF centers."""
     config = credentials.postgresql_connection()
@@ -376,18 +1055,26 @@ def get_cells_by_rf(list_of_dicts):
     return queries
 
 
-def get_cells_all_data_by_rf(list_of_dicts):
+@cache_query
+def get_cells_all_data_by_rf(list_of_dicts, columnar=False):
     """Get all data for cells by their RF centers."""
     config = credentials.postgresql_connection()
     queries = []
     with data_db(config) as db_conn:
         for d in list_of_dicts:
-            queries += [db_conn.gather_data_by_rf_coor(d)]
+            queries += [db_conn.gather_data_by_rf_coor(d, columnar)]
     return queries
 
 
-def get_cells_all_data_by_rf_and_stimuli(rfs, stimuli, sessions=None):
-    """Get all data for cells by their RF centers."""
+@cache_query
+def get_cells_all_data_by_rf_and_stimuli(
+        rfs,
+        stimuli,
+        sessions=None,
+        columnar=False):
+    """Get all data for cells by their RF centers.
+
+    With columnar, each RF's result is a dict of numpy arrays."""
     config = credentials.postgresql_connection()
     queries = []
     with data_db(config) as db_conn:
@@ -396,11 +1083,55 @@ def get_cells_all_data_by_rf_and_stimuli(rfs, stimuli, sessions=None):
                 db_conn.gather_data_by_rf_coor_and_stim(
                     it_rf,
                     stimuli,
-                    sessions)
+                    sessions,
+                    columnar)
             ]
     return queries
 
 
+def stream_cells_all_data_by_rf_and_stimuli(
+        rf,
+        stimuli,
+        sessions=None,
+        itersize=None,
+        row_format='dict'):
+    """Lazily yield all data for cells in one RF query (see stream_query)."""
+    if main_config.db_query_cache and row_format == 'dict':
+        # Cached results are already materialized
+        for row in get_cells_all_data_by_rf_and_stimuli(
+                [rf],
+                stimuli,
+                sessions)[0]:
+            yield row
+        return
+    config = credentials.postgresql_connection()
+    with data_db(config) as db_conn:
+        for row in db_conn.stream_data_by_rf_coor_and_stim(
+                rf,
+                stimuli,
+                sessions,
+                itersize=itersize,
+                row_format=row_format):
+            yield row
+
+
+@cache_query
+def get_cells_all_data_by_rf_grid_and_stimuli(
+        rfs,
+        stimuli,
+        sessions=None,
+        columnar=False):
+    """Get all data for cells in every RF tile with a single query."""
+    config = credentials.postgresql_connection()
+    with data_db(config) as db_conn:
+        queries = db_conn.gather_data_by_rf_grid_and_stim(
+            rfs,
+            stimuli,
+            sessions,
+            columnar)
+    return queries
+
+
 def add_cell_data(
         cell_rf_dict,
         list_of_cell_stim_dicts):
@@ -443,6 +1174,21 @@ def add_cell_data(
         db_conn.populate_db_with_cell_stim(list_of_cell_stim_dicts)
 
 
+def bulk_add_cell_data(
+        cell_rf_dicts,
+        cell_stim_dicts):
+    """Add many cells to the database with COPY.
+
+    Inputs:::
+    cell_rf_dicts: iterable (e.g. a generator) of RF dicts, as in add_cell_data.
+    cell_stim_dicts: iterable of cell stim dicts, as in add_cell_data.
+    """
+    config = credentials.postgresql_connection()
+    with data_db(config) as db_conn:
+        db_conn.populate_db_with_rf(cell_rf_dicts, bulk=True)
+        db_conn.populate_db_with_cell_stim(cell_stim_dicts, bulk=True)
+
+
 def get_performance(experiment_name):
     config = credentials.postgresql_connection()
     with data_db(config) as db_conn:
@@ -451,10 +1197,31 @@ def get_performance(experiment_name):
 
 
 def main(
-        initialize_db):
+        initialize_db,
+        migrate_db=False,
+        explain=False,
+        clear_cache=False,
+        check_prefetch_jobs=False):
+    if check_prefetch_jobs:
+        print 'Checking prefetch with fake jobs.'
+        check_prefetch()
+    if clear_cache:
+        print 'Clearing the query cache.'
+        cache = open_query_cache()
+        cache.clear()
+        cache.close()
     if initialize_db:
         print 'Initializing database.'
         initialize_database()
+    if migrate_db:
+        print 'Migrating database.'
+        migrate_database()
+    if explain:
+        print 'Explaining grid queries.'
+        explain_grid_queries(
+            rfs=default_grid_queries(),
+            stimuli=main_config.available_stims[3:],
+            sessions=main_config.session.values())
 
 
 if __name__ == '__main__':
@@ -464,5 +1231,25 @@ if __name__ == '__main__':
         dest="initialize_db",
         action='store_true',
         help='Recreate your database.')
+    parser.add_argument(
+        "--migrate",
+        dest="migrate_db",
+        action='store_true',
+        help='Apply data_db/migrations to an existing database.')
+    parser.add_argument(
+        "--explain",
+        dest="explain",
+        action='store_true',
+        help='Benchmark grid queries with EXPLAIN ANALYZE.')
+    parser.add_argument(
+        "--clear_cache",
+        dest="clear_cache",
+        action='store_true',
+        help='Empty the local query result cache.')
+    parser.add_argument(
+        "--check_prefetch",
+        dest="check_prefetch_jobs",
+        action='store_true',
+        help='Check prefetch ordering and errors with fake jobs.')
     args = parser.parse_args()
     main(**vars(args))
@@ -0,0 +1,94 @@
+"""Local SQLite cache for data_db query results."""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import cPickle as pickle
+import numpy as np
+
+
+def schema_version(schema_files):
+    """Hash the DB schema/migration files into a cache version string."""
+    digest = hashlib.md5()
+    for f in schema_files:
+        with open(f, 'r') as schema:
+            digest.update(schema.read())
+    return digest.hexdigest()
+
+
+def normalize(x):
+    """Put query parameters in a canonical, JSON-serializable form."""
+    if isinstance(x, np.ndarray):
+        return normalize(x.tolist())
+    if isinstance(x, np.generic):
+        return normalize(x.item())
+    if isinstance(x, dict):
+        return dict((str(k), normalize(v)) for k, v in x.items())
+    if isinstance(x, (list, tuple)):
+        return [normalize(v) for v in x]
+    if isinstance(x, unicode):
+        return x.encode('utf-8')
+    if isinstance(x, float) and x.is_integer():
+        return int(x)
+    return x
+
+
+def query_key(name, *args, **kwargs):
+    """Key a query by its name and normalized parameters."""
+    return hashlib.md5(json.dumps(
+        [name, normalize(args), normalize(kwargs)],
+        sort_keys=True)).hexdigest()
+
+
+class query_cache(object):
+    """Pickled query results in a SQLite file.
+
+    Entries expire after ttl seconds (None to keep them forever) or when
+    the schema version they were stored under changes."""
+
+    def __init__(self, cache_file, ttl, version):
+        cache_dir = os.path.dirname(cache_file)
+        if len(cache_dir) and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.ttl = ttl
+        self.version = version
+        self.conn = sqlite3.connect(cache_file, timeout=60)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS results '
+            '(key TEXT PRIMARY KEY, version TEXT, created REAL, rows BLOB)')
+        self.conn.commit()
+
+    def get(self, key):
+        """Return cached rows for key, or None if missing or stale."""
+        entry = self.conn.execute(
+            'SELECT version, created, rows FROM results WHERE key=?',
+            (key,)).fetchone()
+        if entry is None:
+            return None
+        version, created, rows = entry
+        expired = self.ttl is not None and time.time() - created > self.ttl
+        if version != self.version or expired:
+            self.conn.execute('DELETE FROM results WHERE key=?', (key,))
+            self.conn.commit()
+            return None
+        return pickle.loads(str(rows))
+
+    def set(self, key, rows):
+        """Store rows under key."""
+        self.conn.execute(
+            'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+            (
+                key,
+                self.version,
+                time.time(),
+                sqlite3.Binary(pickle.dumps(rows, pickle.HIGHEST_PROTOCOL))))
+        self.conn.commit()
+
+    def clear(self):
+        """Drop every cached result."""
+        self.conn.execute('DELETE FROM results')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -2,8 +2,15 @@
 import re
 import os
 import sys
+import copy
+import time
+import traceback
 import math
+import functools
 import shutil
+import fcntl
+import threading
+import multiprocessing
 import encode_datasets
 import json
 import string
@@ -18,6 +25,7 @@ import pandas as pd
 from allen_config import Allen_Brain_Observatory_Config
 from data_db import credentials
 from data_db import data_db
+from ops import helper_funcs, build_ledger
 from glob import glob
 from datetime import datetime
 from argparse import ArgumentParser
@@ -36,16 +44,52 @@ def query_neurons_rfs(queries, filter_by_stim, sessions):
     -------
     all_data_dicts : list of dictionaries in lists
     """
-    all_data_dicts = []
-    for q in queries:
-        it_query = data_db.get_cells_all_data_by_rf_and_stimuli(
-            rfs=q,
-            stimuli=filter_by_stim,
-            sessions=sessions)
-        all_data_dicts += it_query
+    rfs = [rf for q in queries for rf in q]
+    all_data_dicts = data_db.get_cells_all_data_by_rf_grid_and_stimuli(
+        rfs=rfs,
+        stimuli=filter_by_stim,
+        sessions=sessions)
     return all_data_dicts
 
 
+def rf_columns(all_data_dicts):
+    """Columnar view of the RF fields used for gridding."""
+    if isinstance(all_data_dicts, dict):
+        return all_data_dicts
+    return data_db.dicts_to_columns(
+        all_data_dicts,
+        [
+            'on_width_y',
+            'on_width_x',
+            'on_center_y',
+            'on_center_x',
+            'cre_line',
+            'structure'])
+
+
+def grid_geometry(all_data_dicts, smod=2):
+    """Tile widths, strides and origins for a grid over the RF centers."""
+    # Get 95th percentile x and y width
+    y_width = int(np.ceil(np.percentile(all_data_dicts['on_width_y'], 95)))
+    x_width = int(np.ceil(np.percentile(all_data_dicts['on_width_x'], 95)))
+
+    # Stride of the neuron bins
+    y_stride = int(y_width/smod)
+    x_stride = int(x_width/smod)
+
+    # Tiles have width and height by the receptive field size
+    y_limit = int(np.floor(np.max(all_data_dicts['on_center_y'])))
+    x_limit = int(np.floor(np.max(all_data_dicts['on_center_x'])))
+    return {
+        'x_width': x_width,
+        'y_width': y_width,
+        'x_stride': x_stride,
+        'y_stride': y_stride,
+        'x_origins': np.arange(0, x_limit, x_stride),
+        'y_origins': np.arange(0, y_limit, y_stride)
+    }
+
+
 def create_grid_queries(all_data_dicts, smod=2):
     """
     Derives coordinates for x_width by y_width grids of the receptive field.
@@ -53,54 +97,93 @@ def create_grid_queries(all_data_dicts, smod=2):
 
     Parameters
     ----------
-    all_data_dicts : list of list of dictionaries of Allen neurons
+    all_data_dicts : list of dictionaries of Allen neurons, or the same
+        data as a columnar dict of arrays
     smod: int for stride
 
     Returns
     -------
     queries : list of dictionaries in lists
     """
-    rf_width_y, rf_width_x = [], []
-    rf_y, rf_x = [], []
-    for dat in all_data_dicts:
-        rf_width_y += [dat['on_width_y']]
-        rf_width_x += [dat['on_width_x']]
-        cre_line = dat['cre_line']
-        structure = dat['structure']
-        rf_y += [dat['on_center_y']]
-        rf_x += [dat['on_center_x']]
+    all_data_dicts = rf_columns(all_data_dicts)
+    cre_line = all_data_dicts['cre_line'][-1]
+    structure = all_data_dicts['structure'][-1]
+    grid = grid_geometry(all_data_dicts, smod)
+    x1s, y1s = np.meshgrid(
+        grid['x_origins'],
+        grid['y_origins'],
+        indexing='ij')
+    queries = [[{
+            'rf_coordinate_range': {  # Get all cells
+                'x_min': int(x1),
+                'x_max': int(x1) + grid['x_width'],
+                'y_min': int(y1),
+                'y_max': int(y1) + grid['y_width'],
+            },
+            'cre_line': cre_line,
+            'structure': structure}]
+        for x1, y1 in zip(x1s.ravel(), y1s.ravel())]
+    return queries, max([grid['x_width'], grid['y_width']])
 
-    # Get 95th percentile x and y width
-    y_width = int(np.ceil(np.percentile(rf_width_y, 95)))
-    x_width = int(np.ceil(np.percentile(rf_width_x, 95)))
 
-    # Stride of the neuron bins
-    y_stride = int(y_width/smod)
-    x_stride = int(x_width/smod)
+def tile_span(centers, width, stride, n_tiles):
+    """First and last tile covering each center.
 
-    # Create queries that have width and height by the receptive field size
-    y_limit = int(np.floor(np.max(rf_y)))
-    x_limit = int(np.floor(np.max(rf_x)))
-    queries = []
-    for x1 in (range(0, x_limit, x_stride)):
-        for y1 in range(0, y_limit, y_stride):
-
-            # Add width to each x1 as long as it's not more than x_max
-            x2 = x1 + x_width
-            # Add width to each y1 as long as it's not more than y_max
-            y2 = y1 + y_width
-
-            # add new coordinate range to queries
-            queries += [[{
-                    'rf_coordinate_range': {  # Get all cells
-                        'x_min': x1,
-                        'x_max': x2,
-                        'y_min': y1,
-                        'y_max': y2,
-                    },
-                    'cre_line': cre_line,
-                    'structure': structure}]]
-    return queries, max([x_width, y_width])
+    Tile i covers [i * stride, i * stride + width), so a center c lies in
+    tiles floor((c - width) / stride) + 1 through floor(c / stride)."""
+    first = np.floor((centers - width) / float(stride)).astype(int) + 1
+    last = np.floor(centers / float(stride)).astype(int)
+    return np.maximum(first, 0), np.minimum(last, n_tiles - 1)
+
+
+def assign_cells_to_tiles(all_data_dicts, smod=2):
+    """
+    Bin already-queried cells into the tiles of create_grid_queries.
+
+    Parameters
+    ----------
+    all_data_dicts : list of dictionaries of Allen neurons, or the same
+        data as a columnar dict of arrays
+    smod: int for stride
+
+    Returns
+    -------
+    tile_cells : list of index arrays into all_data_dicts, one per tile
+        in create_grid_queries order
+    """
+    columns = rf_columns(all_data_dicts)
+    grid = grid_geometry(columns, smod)
+    n_x, n_y = len(grid['x_origins']), len(grid['y_origins'])
+    x = np.asarray(columns['on_center_x'], dtype=np.float64)
+    y = np.asarray(columns['on_center_y'], dtype=np.float64)
+
+    # Apply the tile queries' cre line (LIKE) and structure filters
+    cre_line = str(columns['cre_line'][-1]).lower()
+    structure = str(columns['structure'][-1]).lower()
+    keep = np.isfinite(x) & np.isfinite(y)
+    keep &= np.char.find(
+        np.char.lower(columns['cre_line'].astype(str)), cre_line) >= 0
+    keep &= np.char.lower(columns['structure'].astype(str)) == structure
+    cells = np.nonzero(keep)[0]
+    x_first, x_last = tile_span(
+        x[cells], grid['x_width'], grid['x_stride'], n_x)
+    y_first, y_last = tile_span(
+        y[cells], grid['y_width'], grid['y_stride'], n_y)
+
+    # Expand each cell into every (x, y) tile it overlaps
+    tile_ids, cell_ids = [], []
+    for dx in range(grid['x_width'] // grid['x_stride'] + 1):
+        for dy in range(grid['y_width'] // grid['y_stride'] + 1):
+            it_x, it_y = x_first + dx, y_first + dy
+            overlaps = (it_x <= x_last) & (it_y <= y_last)
+            tile_ids += [it_x[overlaps] * n_y + it_y[overlaps]]
+            cell_ids += [cells[overlaps]]
+    tile_ids = np.concatenate(tile_ids)
+    cell_ids = np.concatenate(cell_ids)
+    order = np.lexsort((cell_ids, tile_ids))
+    tile_ids, cell_ids = tile_ids[order], cell_ids[order]
+    edges = np.searchsorted(tile_ids, np.arange(n_x * n_y + 1))
+    return [cell_ids[edges[t]:edges[t + 1]] for t in range(n_x * n_y)]
 
 
 def make_dir(d):
@@ -128,16 +211,35 @@ def tweak_params(it_exp):
 
 def add_experiment(experiment_file, exp_method_template, experiment):
     """Add experiment method to the CC-BP repo."""
+    add_experiments(experiment_file, exp_method_template, [experiment])
+
+
+def add_experiments(experiment_file, exp_method_template, experiments):
+    """Add experiment methods to the CC-BP repo in a single write.
+
+    experiments.py is rewritten through a temp file and rename under an
+    exclusive lock. Methods that are already defined are skipped, so
+    registering the same experiments twice (e.g. on resume) is safe."""
     with open(exp_method_template, 'r') as f:
-        exp_text = f.readlines()
-    for idx, l in enumerate(exp_text):
-        exp_text[idx] = exp_text[idx].replace('EDIT', experiment)
-        exp_text[idx] = exp_text[idx].replace('RANDALPHA', experiment)
-    with open(experiment_file, 'r') as f:
-        text = f.readlines()
-    text += exp_text
-    with open(experiment_file, 'w') as f:
-        f.writelines(text)
+        template = f.read()
+    with open('%s.lock' % experiment_file, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        with open(experiment_file, 'r') as f:
+            text = f.read()
+        added = []
+        for experiment in experiments:
+            if 'def %s(self):' % experiment in text or experiment in added:
+                continue
+            text += template.replace(
+                'EDIT', experiment).replace('RANDALPHA', experiment)
+            added += [experiment]
+        if len(added):
+            tmp_file = '%s.tmp' % experiment_file
+            with open(tmp_file, 'w') as f:
+                f.write(text)
+            os.rename(tmp_file, experiment_file)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    return added
 
 
 def get_dt_stamp():
@@ -157,18 +259,21 @@ def hp_optim_parameters(parameter_dict, ms_key='model_struct'):
     model_structs = parameter_dict[ms_key]
     parameter_dict = {
         k: v for k, v in parameter_dict.iteritems() if k is not ms_key}
+
+    # Encode each domain once rather than once per model
+    encoded = {}
+    for k, v in parameter_dict.iteritems():
+        if '_domain' in k:
+            if isinstance(v, np.ndarray):
+                v = pd.Series(v).to_json(orient='values')
+            elif isinstance(v, basestring):
+                pass
+            else:
+                v = json.dumps(v)
+        encoded[k] = v  # Handle special-case hp optim flags here.
     combos = []
     for ms in model_structs:
-        it_dict = {}
-        for k, v in parameter_dict.iteritems():
-            if '_domain' in k:
-                if isinstance(v, np.ndarray):
-                    v = pd.Series(v).to_json(orient='values')
-                elif isinstance(v, basestring):
-                    pass
-                else:
-                    v = json.dumps(v)
-            it_dict[k] = v  # Handle special-case hp optim flags here.
+        it_dict = dict(encoded)
         it_dict[ms_key] = ms
         combos += [it_dict]
     return combos
@@ -195,11 +300,7 @@ def prep_exp(
         credentials,
         cluster=False):
     """Prepare exps for contextual circuit repo."""
-    if 'hp_optim' in experiment_dict.keys() and experiment_dict['hp_optim'] is not None:
-        exp_combos = hp_optim_parameters(experiment_dict)
-        # it_exp = tweak_params(it_exp)
-    else:
-        exp_combos = package_parameters(experiment_dict)
+    exp_combos = list(experiment_combos(experiment_dict))
     with allen_db(
             # config=db_config,
             cluster=cluster,
@@ -207,6 +308,16 @@ def prep_exp(
         db_conn.populate_db(exp_combos)
 
 
+def experiment_combos(experiment_dict, n_samples=None, sampling='random'):
+    """Hp combos of an experiment, as an iterable of populate_db rows."""
+    if 'hp_optim' in experiment_dict.keys() and experiment_dict['hp_optim'] is not None:
+        return hp_optim_parameters(experiment_dict)
+    return iter_parameter_combos(
+        experiment_dict,
+        n_samples=n_samples,
+        sampling=sampling)
+
+
 def query_hp_hist(
         experiment_name,
         # db_config,
@@ -222,6 +333,20 @@ def query_hp_hist(
     return perfs
 
 
+def query_performance(
+        credentials,
+        experiment_names=None,
+        experiment_link=None,
+        cluster=False):
+    """Summarize performance of many experiments (see get_performance_bulk)."""
+    with allen_db(
+            cluster=cluster,
+            credentials=credentials) as db_conn:
+        return db_conn.get_performance_bulk(
+            experiment_names=experiment_names,
+            experiment_link=experiment_link)
+
+
 def sel_exp_query(
         experiment_name,
         model,
@@ -241,15 +366,101 @@ def sel_exp_query(
     return perfs
 
 
+def sel_exps_query(
+        experiment_names,
+        model,
+        credentials,
+        cluster=False):
+    """Get a model's performance rows for many experiments in one query.
+
+    Returns a dict of rows per experiment name."""
+    proc_model_name = '%%/%s' % model
+    with allen_db(
+            cluster=cluster,
+            credentials=credentials) as db_conn:
+        perfs = db_conn.get_performance_by_model_bulk(
+            experiment_names=experiment_names,
+            model=proc_model_name)
+    exp_perfs = {name: [] for name in experiment_names}
+    for row in perfs:
+        exp_perfs[row['experiment_name']] += [row]
+    return exp_perfs
+
+
 def package_parameters(parameter_dict):
     """Derive combinations of experiment parameters."""
+    return list(iter_parameter_combos(parameter_dict))
+
+
+def unique_values(values):
+    """Drop repeated values from a list, keeping the first of each."""
+    seen, unique = set(), []
+    for v in values:
+        if repr(v) not in seen:
+            seen.add(repr(v))
+            unique += [v]
+    return unique
+
+
+def iter_parameter_combos(
+        parameter_dict,
+        n_samples=None,
+        sampling='random',
+        seed=None):
+    """
+    Lazily derive combinations of experiment parameters.
+
+    Repeated values in a parameter's list are dropped, so every combo is
+    unique. With n_samples, only that many combos are drawn from the grid:
+    uniformly at random (sampling='random') or by Latin hypercube over
+    each parameter's values (sampling='lhs', which may yield fewer combos
+    when it draws one twice). Memory grows with n_samples, never with the
+    size of the grid.
+    """
     parameter_dict = {
-        k: v for k, v in parameter_dict.iteritems() if isinstance(v, list)
+        k: unique_values(v) for k, v in parameter_dict.iteritems()
+        if isinstance(v, list)
     }
     keys_sorted = sorted(parameter_dict)
-    values = list(it.product(*(parameter_dict[key] for key in keys_sorted)))
-    combos = tuple({k: v for k, v in zip(keys_sorted, row)} for row in values)
-    return list(combos)
+    values = [parameter_dict[key] for key in keys_sorted]
+    n_combos = functools.reduce(
+        lambda x, y: x * y, [len(v) for v in values], 1)
+    if n_samples is None or n_samples >= n_combos:
+        for row in it.product(*values):
+            yield {k: v for k, v in zip(keys_sorted, row)}
+        return
+    rng = np.random.RandomState(seed)
+    if sampling == 'random':
+        rows = random_combo_indices(values, n_samples, rng)
+    elif sampling == 'lhs':
+        rows = lhs_combo_indices(values, n_samples, rng)
+    else:
+        raise RuntimeError('Cannot understand combo sampling: %s' % sampling)
+    for row in rows:
+        yield {k: v[i] for k, v, i in zip(keys_sorted, values, row)}
+
+
+def random_combo_indices(values, n_samples, rng):
+    """Distinct random index tuples into the grid of values."""
+    seen = set()
+    while len(seen) < n_samples:
+        row = tuple(rng.randint(len(v)) for v in values)
+        if row not in seen:
+            seen.add(row)
+            yield row
+
+
+def lhs_combo_indices(values, n_samples, rng):
+    """Distinct Latin hypercube index tuples into the grid of values."""
+    strata = [rng.permutation(n_samples) for _ in values]
+    seen = set()
+    for idx in range(n_samples):
+        row = tuple(
+            int((s[idx] + rng.uniform()) * len(v) / n_samples)
+            for s, v in zip(strata, values))
+        if row not in seen:
+            seen.add(row)
+            yield row
 
 
 def prepare_connection(unpw, port=''):
@@ -321,11 +532,14 @@ class allen_db(object):
             self.close_db(commit=False)
         else:
             self.close_db()
-        return self
+        return False  # Let exceptions propagate to the caller
 
     def close_db(self, commit=True):
-        """Commit changes and exit the DB."""
-        self.conn.commit()
+        """Commit (or roll back) changes and exit the DB."""
+        if commit:
+            self.conn.commit()
+        else:
+            self.conn.rollback()
         self.cur.close()
         self.conn.close()
 
@@ -564,6 +778,87 @@ class allen_db(object):
         if self.status_message:
             self.return_status('INSERT')
 
+    def populate_db_batch(self, namedict, experiment_link=False, page_size=1000):
+        """
+        Add hp combos from many experiments in one transaction.
+        ::
+        namedict: iterable of combos, e.g. experiment_combos of several
+            datasets; it is consumed page_size rows at a time
+        experiment_link: as in populate_db
+        page_size: rows per multi-row INSERT
+        Returns the number of rows inserted.
+        """
+        columns = [
+            'experiment_name',
+            'model_struct',
+            'loss_function',
+            'regularization_type',
+            'regularization_strength',
+            'optimizer',
+            'lr',
+            'dataset',
+            'regularization_type_domain',
+            'regularization_strength_domain',
+            'optimizer_domain',
+            'lr_domain',
+            'timesteps',
+            'timesteps_domain',
+            'u_t_domain',
+            'q_t_domain',
+            't_t_domain',
+            'p_t_domain',
+            'u_t',
+            'q_t',
+            't_t',
+            'p_t',
+            'hp_optim',
+            'hp_max_studies',
+            'hp_current_iteration',
+            'experiment_iteration',
+            'normalize_labels',
+            'filter_size',
+            'filter_size_domain'
+        ]
+        if experiment_link:
+            columns += ['experiment_link']
+        namedict = iter(namedict)
+        n_rows, experiment_names = 0, set()
+        self.cur.execute('BEGIN')
+        try:
+            while True:
+                page = list(it.islice(namedict, page_size))
+                if not len(page):
+                    break
+                page = self.fix_namedict(page, 'experiments')
+                psycopg2.extras.execute_values(
+                    self.cur,
+                    'INSERT INTO experiments (%s) VALUES %%s' % ', '.join(
+                        columns),
+                    page,
+                    template='(%s)' % ', '.join(
+                        '%%(%s)s' % c for c in columns),
+                    page_size=page_size)
+                experiment_names.update(d['experiment_name'] for d in page)
+                n_rows += len(page)
+            if not experiment_link and len(experiment_names):
+                # Link each experiment to itself, as populate_db does
+                self.cur.execute(
+                    """
+                    UPDATE experiments
+                    SET experiment_link=_id
+                    WHERE experiment_name = ANY(%(experiment_names)s)
+                    """,
+                    {
+                        'experiment_names': list(experiment_names)
+                    })
+            self.cur.execute('COMMIT')
+        except Exception:
+            self.cur.execute('ROLLBACK')
+            raise
+        if self.status_message:
+            self.return_status('COMMIT')
+        return n_rows
+
     def get_parameters(self, experiment_name=None, random=True):
         """Pull parameters DEPRECIATED."""
         if experiment_name is not None:
@@ -594,42 +889,134 @@ class allen_db(object):
 
     def get_parameters_and_reserve(self, experiment_name=None, random=True):
         """Pull parameters and update the in process table."""
-        if experiment_name is not None:
-            exp_string = """experiment_name='%s' and""" % experiment_name
-        else:
-            exp_string = """"""
-        if random:
-            rand_string = """ORDER BY random()"""
-        else:
-            rand_string = """"""
+        experiments = self.reserve_experiments(
+            k=1,
+            experiment_name=experiment_name,
+            random=random)
+        if len(experiments):
+            return experiments[0]
+        return None
+
+    def reserve_experiments(self, k=1, experiment_name=None, random=True):
+        """
+        Reserve up to k unclaimed experiments and return their rows.
+
+        Candidates are read in _id order and claimed with FOR UPDATE SKIP
+        LOCKED, so workers polling at the same time skip each other's rows
+        instead of waiting or sorting the whole table. ON CONFLICT (with
+        the unique index from create_queue_indexes) drops rows another
+        worker reserved in the meantime, so fewer than k rows may come
+        back even if work remains. random=True starts the scan at a random
+        _id and wraps around, which spreads workers over the queue while
+        still walking the _id index.
+        """
+        self.check_queue_indexes()
+        if not random:
+            return self.claim_experiments(k=k, experiment_name=experiment_name)
         self.cur.execute(
             """
-            INSERT INTO in_process (experiment_id, experiment_name)
-            (SELECT _id, experiment_name FROM experiments h
-            WHERE %s NOT EXISTS (
-                SELECT 1
-                FROM in_process i
-                WHERE h._id = i.experiment_id
-                )
-            %s LIMIT 1)
-            RETURNING experiment_id
-            """ % (
-                exp_string,
-                rand_string,
-                )
+            SELECT floor(lo + random() * (hi - lo + 1))::bigint AS start_id
+            FROM (SELECT min(_id) AS lo, max(_id) AS hi FROM experiments) b
+            """
         )
+        start_id = self.cur.fetchone()['start_id']
+        if start_id is None:
+            return []  # No experiments
+        experiments = self.claim_experiments(
+            k=k,
+            experiment_name=experiment_name,
+            start_id=start_id)
+        if len(experiments) < k:
+            experiments += self.claim_experiments(
+                k=k - len(experiments),
+                experiment_name=experiment_name,
+                end_id=start_id)
+        return experiments
+
+    def claim_experiments(
+            self,
+            k,
+            experiment_name=None,
+            start_id=None,
+            end_id=None):
+        """Reserve up to k unclaimed experiments with start_id <= _id < end_id."""
+        where = []
+        if experiment_name is not None:
+            where += ['experiment_name=%(experiment_name)s']
+        if start_id is not None:
+            where += ['_id >= %(start_id)s']
+        if end_id is not None:
+            where += ['_id < %(end_id)s']
+        where += ["""NOT EXISTS (
+                    SELECT 1
+                    FROM in_process i
+                    WHERE h._id = i.experiment_id
+                    )"""]
         self.cur.execute(
             """
-            SELECT * FROM experiments
-            WHERE _id=%(_id)s
-            """,
+            WITH todo AS (
+                SELECT _id, experiment_name FROM experiments h
+                WHERE %s
+                ORDER BY _id
+                LIMIT %%(k)s
+                FOR UPDATE SKIP LOCKED
+            ), reserved AS (
+                INSERT INTO in_process (experiment_id, experiment_name)
+                SELECT _id, experiment_name FROM todo
+                ON CONFLICT DO NOTHING
+                RETURNING experiment_id
+            )
+            SELECT h.* FROM experiments h
+            INNER JOIN reserved r ON h._id = r.experiment_id
+            ORDER BY h._id
+            """ % ' and '.join(where),
             {
-                '_id': self.cur.fetchone()['experiment_id']
+                'k': k,
+                'experiment_name': experiment_name,
+                'start_id': start_id,
+                'end_id': end_id
             }
         )
         if self.status_message:
             self.return_status('SELECT')
-        return self.cur.fetchone()
+        return self.cur.fetchall()
+
+    def check_queue_indexes(self):
+        """Warn (once) if in_process lacks a unique experiment_id index."""
+        if getattr(self, 'queue_index_checked', False):
+            return
+        self.cur.execute(
+            """
+            SELECT 1 FROM pg_index i
+            INNER JOIN pg_attribute a
+            ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+            WHERE i.indrelid = 'in_process'::regclass
+            AND i.indisunique
+            AND i.indnatts = 1
+            AND a.attname = 'experiment_id'
+            """
+        )
+        if self.cur.fetchone() is None:
+            print 'WARNING: in_process has no unique experiment_id index, ' \
+                'so concurrent workers can reserve the same experiment. ' \
+                'Run declare_datasets_loop.py --create_queue_indexes.'
+        self.queue_index_checked = True
+
+    def create_queue_indexes(self):
+        """Indexes for reserve_experiments.
+
+        The unique in_process index is what lets concurrent reservations
+        resolve with ON CONFLICT DO NOTHING."""
+        self.cur.execute(
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS in_process_experiment_id_idx
+            ON in_process (experiment_id);
+            CREATE INDEX IF NOT EXISTS experiments_experiment_name_idx
+            ON experiments (experiment_name, _id);
+            """
+        )
+        if self.status_message:
+            self.return_status('CREATE')
 
     def list_experiments(self):
         """List all experiments."""
@@ -660,7 +1047,6 @@ class allen_db(object):
 
     def get_performance(self, experiment_name):
         """Get experiment performance."""
-        import ipdb; ipdb.set_trace()
         self.cur.execute(
             """
             SELECT validation_loss FROM performance AS P
@@ -675,6 +1061,60 @@ class allen_db(object):
             self.return_status('SELECT')
         return self.cur.fetchall()
 
+    def get_performance_bulk(self, experiment_names=None, experiment_link=None):
+        """
+        Summarize validation loss per experiment and model in one query.
+        ::
+        experiment_names: list of experiment names to summarize
+        experiment_link: summarize every experiment with this link
+        Returns a structured array with one row per experiment/model_struct
+        and fields experiment_name, model_struct, min_validation_loss,
+        max_validation_loss, last_validation_loss (at the latest training
+        step) and n_evaluations.
+        """
+        assert experiment_names is not None or experiment_link is not None,\
+            'Pass experiment_names and/or an experiment_link.'
+        cur = self.conn.cursor()
+        cur.execute(
+            """
+            SELECT
+            P.experiment_name,
+            E.model_struct,
+            min(P.validation_loss),
+            max(P.validation_loss),
+            (array_agg(P.validation_loss ORDER BY P.training_step DESC))[1],
+            count(*)
+            FROM performance AS P
+            INNER JOIN experiments AS E ON E._id=P.experiment_id
+            WHERE P.experiment_name = ANY(%(experiment_names)s::text[])
+            OR E.experiment_link = %(experiment_link)s
+            GROUP BY P.experiment_name, E.model_struct
+            ORDER BY P.experiment_name, E.model_struct
+            """,
+            {
+                'experiment_names': list(experiment_names or []),
+                'experiment_link': experiment_link
+            }
+        )
+        rows = []
+        for r in cur.fetchall():
+            losses = tuple(np.nan if v is None else v for v in r[2:5])
+            rows += [(r[0], r[1] or '') + losses + (r[5],)]
+        cur.close()
+        if self.status_message:
+            self.return_status('SELECT')
+        name_len = max([1] + [len(r[0]) for r in rows])
+        model_len = max([1] + [len(r[1]) for r in rows])
+        return np.array(
+            rows,
+            dtype=[
+                ('experiment_name', 'S%s' % name_len),
+                ('model_struct', 'S%s' % model_len),
+                ('min_validation_loss', np.float64),
+                ('max_validation_loss', np.float64),
+                ('last_validation_loss', np.float64),
+                ('n_evaluations', np.int64)])
+
     def get_performance_by_model(self, experiment_name, model):
         """Get experiment performance."""
         self.cur.execute(
@@ -693,6 +1133,24 @@ class allen_db(object):
             self.return_status('SELECT')
         return self.cur.fetchall()
 
+    def get_performance_by_model_bulk(self, experiment_names, model):
+        """Get one model's performance for many experiments."""
+        self.cur.execute(
+            """
+            SELECT * FROM performance AS P
+            LEFT JOIN experiments ON experiments._id=P.experiment_id
+            WHERE P.experiment_name = ANY(%(experiment_names)s::text[])
+            AND model_struct LIKE %(model)s
+            """,
+            {
+                'experiment_names': list(experiment_names),
+                'model': model
+            }
+        )
+        if self.status_message:
+            self.return_status('SELECT')
+        return self.cur.fetchall()
+
     def remove_experiment(self, experiment_name):
         """Delete an experiment from all tables."""
         self.cur.execute(
@@ -985,47 +1443,25 @@ class declare_allen_datasets():
         return exp_dict
 
 
-def process_dataset(
+def encode_tile(
         dataset_method,
         rf_dict,
         this_dataset_name,
         model_directory,
         model_templates,
-        exps,
-        template_experiment,
-        session_name,
-        meta_dir,
-        db_config,
-        experiment_file,
         main_config,
         N=16,
         idx=0,
-        cluster=False,
-        filter_size=None,  # NOT IMPLEMENTED YET
-        exp_method_template=None):
+        data_dicts=None,
+        method_name=None):
+    """Encode one dataset and copy its model templates.
+
+    Touches no shared state, so datasets can be encoded in parallel.
+    Returns everything register_tile needs plus the encoding time."""
+    start = time.time()
 
     # 1. Prepare dataset
-    x_min = np.floor(rf_dict['on_center_x'])
-    y_min = np.floor(rf_dict['on_center_y'])
-    if 'on_center_x_max' in rf_dict:
-        x_max = np.floor(rf_dict['on_center_x_max'])
-    else:
-        x_max = np.floor(rf_dict['on_center_x']) + 1
-    if 'on_center_y_max' in rf_dict:
-        y_max = np.floor(rf_dict['on_center_y_max'])
-    else:
-        y_max = np.floor(rf_dict['on_center_y']) + 1
-    rf_query = dataset_method['rf_query'][0]
-    rf_query['rf_coordinate_range']['x_min'] = x_min
-    rf_query['rf_coordinate_range']['x_max'] = x_max
-    rf_query['rf_coordinate_range']['y_min'] = y_min
-    rf_query['rf_coordinate_range']['y_max'] = y_max
-    rf_query['structure'] = rf_dict[
-        'structure']
-    rf_query['cre_line'] = rf_dict[
-        'cre_line']
-    rf_query['imaging_depth'] = rf_dict[
-        'imaging_depth']
+    rf_query = tile_rf_query(dataset_method, rf_dict)
     dataset_method['rf_query'][0] = rf_query
     dataset_name = '%s_%s_%s_%s_%s_%s' % (
         rf_dict['structure'],
@@ -1036,18 +1472,17 @@ def process_dataset(
         idx)
 
     print 'Creating dataset %s.' % dataset_name
-    method_name = ''.join(
-        random.choice(  # TODO: FIX THIS
-            string.ascii_uppercase + string.ascii_lowercase)
-        for _ in range(N))
-    method_name = this_dataset_name + method_name
+    if method_name is None:
+        method_name = draw_method_name(this_dataset_name, N)
     dataset_method['experiment_name'] = method_name
     dataset_method['dataset_name'] = dataset_name
     dataset_method['cell_specimen_id'] = rf_dict['cell_specimen_id']
     dataset_method['cc_data_dir'] = main_config.cc_data_dir
 
     # 2. Encode dataset
-    final_rf_dicts = encode_datasets.main(dataset_method)
+    final_rf_dicts = encode_datasets.main(
+        dataset_method,
+        data_dicts=data_dicts)
 
     if final_rf_dicts:
         # 3. Prepare models in CC-BP
@@ -1060,39 +1495,189 @@ def process_dataset(
                 new_model_dir,
                 f.split(os.path.sep)[-1])
             shutil.copy(f, dest)
+    return {
+        'dataset_method': dataset_method,
+        'dataset_name': dataset_name,
+        'method_name': method_name,
+        'rf_dict': rf_dict,
+        'final_rf_dicts': final_rf_dicts,
+        'encode_seconds': time.time() - start
+    }
+
+
+def draw_method_name(this_dataset_name, N=16):
+    """Random experiment method name for a dataset."""
+    return this_dataset_name + ''.join(
+        random.choice(  # TODO: FIX THIS
+            string.ascii_uppercase + string.ascii_lowercase)
+        for _ in range(N))
+
+
+def encode_tile_job(job):
+    """Run encode_tile, returning {'error': traceback} if it fails."""
+    try:
+        return encode_tile(**job)
+    except Exception:
+        return {'error': traceback.format_exc()}
+
+
+def prefetch_tile_cells(dataset_method, rf_dict):
+    """query_tile_cells, or None (encode_tile queries again) on failure."""
+    try:
+        return query_tile_cells(dataset_method, rf_dict)
+    except Exception:
+        return None
+
+
+def seed_worker():
+    """Reseed forked workers so they draw distinct method names."""
+    random.seed()
+    np.random.seed()
+
+
+def register_tile(
+        tile,
+        exps,
+        template_experiment,
+        session_name,
+        meta_dir,
+        db_config,
+        experiment_file,
+        cluster=False,
+        exp_method_template=None,
+        defer=False):
+    """Add an encoded dataset to the CC-BP DB and experiments.py.
+
+    These steps write shared state, so only one process should run them.
+    With defer=True the DB rows and experiments.py method are left for
+    the caller to add in one batch (see populate_db_batch and
+    add_experiments). Returns False if the dataset had no cells to
+    register."""
+    if not tile['final_rf_dicts']:
+        return False
+    method_name = tile['method_name']
+
+    # 4. Add dataset to CC-BP database
+    it_exp = tile_experiment(
+        tile,
+        exps=exps,
+        template_experiment=template_experiment,
+        session_name=session_name)
+    np.savez(
+        os.path.join(meta_dir, tile['dataset_name']),
+        it_exp=it_exp,
+        dataset_method=tile['dataset_method'],
+        rf_data=tile['rf_dict'],
+        final_rf_dicts=tile['final_rf_dicts'])
+    if defer:
+        return True
+    prep_exp(
+        it_exp,
+        credentials=db_config,
+        cluster=cluster)
+
+    # 5. Add the experiment method
+    add_experiment(
+        experiment_file,
+        exp_method_template,
+        method_name)
+    return True
+
+
+def tile_experiment(tile, exps, template_experiment, session_name):
+    """CC-BP experiment dict for an encoded dataset."""
+    it_exp = exps[template_experiment]()
+    it_exp['experiment_name'] = [tile['method_name']]  # [dataset_name]
+    it_exp['dataset'] = [tile['method_name']]  # [dataset_name]
+    it_exp['experiment_link'] = [session_name]
+    return tweak_params(it_exp)
+
+
+def process_dataset(
+        dataset_method,
+        rf_dict,
+        this_dataset_name,
+        model_directory,
+        model_templates,
+        exps,
+        template_experiment,
+        session_name,
+        meta_dir,
+        db_config,
+        experiment_file,
+        main_config,
+        N=16,
+        idx=0,
+        cluster=False,
+        filter_size=None,  # NOT IMPLEMENTED YET
+        exp_method_template=None,
+        data_dicts=None):
+    """Encode and register a single dataset."""
+    tile = encode_tile(
+        dataset_method=dataset_method,
+        rf_dict=rf_dict,
+        this_dataset_name=this_dataset_name,
+        model_directory=model_directory,
+        model_templates=model_templates,
+        main_config=main_config,
+        N=N,
+        idx=idx,
+        data_dicts=data_dicts)
+    return register_tile(
+        tile,
+        exps=exps,
+        template_experiment=template_experiment,
+        session_name=session_name,
+        meta_dir=meta_dir,
+        db_config=db_config,
+        experiment_file=experiment_file,
+        cluster=cluster,
+        exp_method_template=exp_method_template)
+
+
+def tile_rf_query(dataset_method, rf_dict):
+    """Copy of dataset_method's rf_query covering rf_dict's RF extent."""
+    x_min = np.floor(rf_dict['on_center_x'])
+    y_min = np.floor(rf_dict['on_center_y'])
+    if 'on_center_x_max' in rf_dict:
+        x_max = np.floor(rf_dict['on_center_x_max'])
+    else:
+        x_max = np.floor(rf_dict['on_center_x']) + 1
+    if 'on_center_y_max' in rf_dict:
+        y_max = np.floor(rf_dict['on_center_y_max'])
+    else:
+        y_max = np.floor(rf_dict['on_center_y']) + 1
+    rf_query = copy.deepcopy(dataset_method['rf_query'][0])
+    rf_query['rf_coordinate_range']['x_min'] = x_min
+    rf_query['rf_coordinate_range']['x_max'] = x_max
+    rf_query['rf_coordinate_range']['y_min'] = y_min
+    rf_query['rf_coordinate_range']['y_max'] = y_max
+    rf_query['structure'] = rf_dict[
+        'structure']
+    rf_query['cre_line'] = rf_dict[
+        'cre_line']
+    rf_query['imaging_depth'] = rf_dict[
+        'imaging_depth']
+    return rf_query
 
-        # 4. Add dataset to CC-BP database
-        it_exp = exps[template_experiment]()
-        it_exp['experiment_name'] = [method_name]  # [dataset_name]
-        it_exp['dataset'] = [method_name]  # [dataset_name]
-        it_exp['experiment_link'] = [session_name]
-        it_exp = tweak_params(it_exp)
-        np.savez(
-            os.path.join(meta_dir, dataset_name),
-            it_exp=it_exp,
-            dataset_method=dataset_method,
-            rf_data=rf_dict,
-            final_rf_dicts=final_rf_dicts)
-        prep_exp(
-            it_exp,
-            credentials=db_config,
-            cluster=cluster)
-
-        # 5. Add the experiment method
-        add_experiment(
-            experiment_file,
-            exp_method_template,
-            method_name)
+
+def query_tile_cells(dataset_method, rf_dict):
+    """Query the cells that process_dataset will encode for rf_dict."""
+    tile_method = dict(dataset_method)
+    tile_method['rf_query'] = [tile_rf_query(dataset_method, rf_dict)]
+    return list(encode_datasets.query_cells(tile_method))
 
 
 def rf_extents(rf_dict):
-    """Find neuron RF extents."""
-    x_min, y_min, x_max, y_max = np.inf, np.inf, -np.inf, -np.inf
-    for rf in rf_dict:
-        x_min = np.min([rf['on_center_x'], x_min])
-        x_max = np.max([rf['on_center_x'], x_max])
-        y_min = np.min([rf['on_center_y'], y_min])
-        y_max = np.max([rf['on_center_y'], y_max])
+    """Find neuron RF extents (from row dicts or a columnar dict)."""
+    if not isinstance(rf_dict, dict):
+        rf_dict = data_db.dicts_to_columns(
+            rf_dict,
+            ['on_center_x', 'on_center_y'])
+    x_min = np.min(rf_dict['on_center_x'])
+    x_max = np.max(rf_dict['on_center_x'])
+    y_min = np.min(rf_dict['on_center_y'])
+    y_max = np.max(rf_dict['on_center_y'])
     if x_min == x_max:
         x_max += 1
     if y_min == y_max:
@@ -1114,6 +1699,242 @@ def calculate_rf_size(rf_size, downsample):
     return rf_size * d_px
 
 
+def stimulus_frame_info(data_dicts, exp_dict):
+    """
+    Stimulus name per session, and event and frame sizes per stimulus.
+
+    Reads one cell's meta data, stimulus table and ROI mask per session
+    and only the header of each stimulus file; no traces are loaded.
+    """
+    itemsize = np.dtype(exp_dict['image_type']).itemsize
+    session_stimuli, stimulus_info = {}, {}
+    for d in data_dicts:
+        if d['session'] in session_stimuli:
+            continue
+        cell_data = encode_datasets.load_cell_meta(d)
+        stim = cell_data['stim_template'].item()
+        session_stimuli[d['session']] = stim
+        if stim in stimulus_info:
+            continue
+        stim_table = encode_datasets.load_data(
+            cell_data['stim_table'].item(),
+            allow_pkls=True)['stim_table']
+        roi_mask = encode_datasets.load_data(
+            cell_data['ROImask'].item(),
+            allow_pkls=True)['roi_loc_mask']
+        shape = np.load(stim, mmap_mode='r').shape
+        h, w = shape[1:3]
+        process = [
+            v for k, v in exp_dict['process_stimuli'].iteritems()
+            if k in stim]
+        if len(process) and 'pad' in process[0]:
+            h, w = process[0]['pad'][:2]
+        if len(process) and 'resize' in process[0]:
+            h, w = process[0]['resize'][:2]
+        frame_values = h * w * (shape[3] if len(shape) > 3 else 1)
+        if exp_dict['st_conv'] and isinstance(
+                exp_dict['neural_delay'], list):
+            # A list is a [start, end) range of offsets; an int is one offset
+            frame_values *= len(range(*exp_dict['neural_delay']))
+        stimulus_info[stim] = {
+            'n_events': len(stim_table),
+            'raw_bytes': int(np.prod(shape)) * itemsize,
+            'frame_bytes': frame_values * itemsize,
+            'mask_bytes': roi_mask.size * itemsize
+        }
+    return session_stimuli, stimulus_info
+
+
+def estimate_tile(tile, session_stimuli, stimulus_info, exp_dict):
+    """
+    Predicted events, TFRecord bytes and peak memory of one dataset.
+
+    Follows encode_datasets' multi-neuron path: cells are consolidated
+    per stimulus up to their shared number of repeats and events are
+    sliced every slice_frames. Cell filters applied while encoding
+    (stimulus orders, only_process_n) are ignored, so this is an upper
+    bound.
+    """
+    slice_frames = exp_dict['slice_frames'] or 1
+    stim_cells = {}
+    for d in tile:
+        stim_cells.setdefault(
+            session_stimuli[d['session']], []).append(d['cell_specimen_id'])
+    events, tf_bytes = 0, 0
+    memory = max([stimulus_info[stim]['raw_bytes'] for stim in stim_cells])
+    for stim, cells in stim_cells.iteritems():
+        info = stimulus_info[stim]
+        n_cells = len(np.unique(cells))
+        repeats = np.unique(cells, return_counts=True)[1].min()
+        n_events = int(np.ceil(
+            repeats * info['n_events'] / float(slice_frames)))
+        event_bytes = 0
+        for k in exp_dict['include_targets'].keys():
+            if k == 'image':
+                event_bytes += info['frame_bytes']
+            elif k == 'ROImask':
+                event_bytes += info['mask_bytes'] * n_cells
+            elif k in ['label', 'cell_specimen_id']:
+                event_bytes += 4 * n_cells
+            else:
+                event_bytes += 8
+        events += n_events
+        tf_bytes += n_events * event_bytes
+        memory += info['n_events'] * info['frame_bytes']
+        memory += len(cells) * info['mask_bytes']
+        memory += n_events * 4 * n_cells
+    return {
+        'n_cells': len(np.unique([d['cell_specimen_id'] for d in tile])),
+        'events': events,
+        'tf_bytes': tf_bytes,
+        'memory': memory
+    }
+
+
+def timing_model(multi_exps):
+    """
+    Fit encode_seconds = intercept + per_cell * n_cells over the
+    timing.jsonl logs of previous runs. Returns None without history.
+    """
+    timings = []
+    for timing_file in glob(os.path.join(multi_exps, '*', 'timing.jsonl')):
+        with open(timing_file, 'r') as f:
+            timings += [json.loads(l) for l in f if len(l.strip())]
+    timings = [t for t in timings if t['registered']]
+    if not len(timings):
+        return None
+    n_cells = np.asarray([t['n_cells'] for t in timings], dtype=np.float64)
+    encode = np.asarray([t['encode_seconds'] for t in timings])
+    if len(np.unique(n_cells)) > 1:
+        per_cell, intercept = np.polyfit(n_cells, encode, 1)
+    else:
+        per_cell, intercept = encode.mean() / max(n_cells.mean(), 1), 0.
+    return {
+        'intercept': intercept,
+        'per_cell': per_cell,
+        'register_seconds': np.mean(
+            [t['register_seconds'] for t in timings]),
+        'n_datasets': len(timings)
+    }
+
+
+def estimate_run(tiles, dataset_method, main_config, workers=1):
+    """Print predicted TFRecord bytes, events, peak memory and wall time
+    for encoding each list of cell dicts in tiles as a dataset."""
+    session_stimuli, stimulus_info = stimulus_frame_info(
+        flatten_list(tiles),
+        dataset_method)
+    estimates = [
+        estimate_tile(tile, session_stimuli, stimulus_info, dataset_method)
+        for tile in tiles]
+    gb = float(1024 ** 3)
+    print 'Datasets: %s; cells per dataset: %s-%s.' % (
+        len(estimates),
+        min([e['n_cells'] for e in estimates]),
+        max([e['n_cells'] for e in estimates]))
+    print 'Predicted events: %s.' % sum([e['events'] for e in estimates])
+    print 'Predicted TFRecord size: %.2f GB.' % (
+        sum([e['tf_bytes'] for e in estimates]) / gb)
+    print 'Predicted peak memory: %.2f GB (%s workers).' % (
+        max([e['memory'] for e in estimates]) * workers / gb,
+        workers)
+    timing = timing_model(main_config.multi_exps)
+    if timing is None:
+        print 'No timing.jsonl history in %s to predict wall time.' % (
+            main_config.multi_exps)
+        wall_seconds = None
+    else:
+        encode_seconds = sum([
+            max(timing['intercept'] + timing['per_cell'] * e['n_cells'], 0)
+            for e in estimates])
+        wall_seconds = encode_seconds / workers + len(estimates) * timing[
+            'register_seconds']
+        print 'Predicted wall time: %.1f hours (from %s timed datasets).' % (
+            wall_seconds / 3600.,
+            timing['n_datasets'])
+    return {
+        'datasets': estimates,
+        'wall_seconds': wall_seconds
+    }
+
+
+def benchmark_reservations(
+        credentials,
+        workers=8,
+        rounds=50,
+        k=1,
+        cluster=False):
+    """
+    Time concurrent reserve_experiments calls.
+
+    Each worker thread holds its own autocommit connection and calls
+    reserve_experiments with its defaults (random start on the _id
+    index), so every reservation runs and commits as it does for real
+    workers. The experiments
+    reserved are deleted from in_process afterwards; run this while no
+    real workers are polling, as they cannot claim those experiments
+    until then. Reports throughput, latency and any experiment handed
+    out twice (which should never happen).
+    """
+    with allen_db(cluster=cluster, credentials=credentials) as db_conn:
+        db_conn.create_queue_indexes()
+    latencies, reserved, errors = [], [], []
+    lock = threading.Lock()
+
+    def worker():
+        try:
+            with allen_db(
+                    cluster=cluster,
+                    credentials=credentials) as db_conn:
+                for r in range(rounds):
+                    start = time.time()
+                    rows = db_conn.reserve_experiments(k=k)
+                    with lock:
+                        latencies.append(time.time() - start)
+                        reserved.extend([row['_id'] for row in rows])
+        except Exception:
+            with lock:
+                errors.append(traceback.format_exc())
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    for e in errors:
+        print 'Benchmark worker failed:\n%s' % e
+    latencies = np.asarray(latencies) * 1000
+    print 'Reserved %s experiments (k=%s) with %s workers in %.2fs.' % (
+        len(reserved),
+        k,
+        workers,
+        elapsed)
+    if len(latencies):
+        print 'Calls/s: %.1f; latency ms: median %.2f, p95 %.2f.' % (
+            len(latencies) / elapsed,
+            np.median(latencies),
+            np.percentile(latencies, 95))
+    print 'Duplicate reservations: %s.' % (len(reserved) - len(set(reserved)))
+
+    # Release the benchmark's reservations
+    with allen_db(cluster=cluster, credentials=credentials) as db_conn:
+        db_conn.cur.execute(
+            """
+            DELETE FROM in_process WHERE experiment_id = ANY(%(ids)s)
+            """,
+            {
+                'ids': list(set(reserved))
+            }
+        )
+    return {
+        'elapsed': elapsed,
+        'latencies': latencies,
+        'reserved': reserved
+    }
+
+
 def build_multiple_datasets(
         template_dataset='ALLEN_st_cells_1_movies',
         template_experiment='ALLEN_st_selected_cells_1',
@@ -1121,8 +1942,28 @@ def build_multiple_datasets(
         this_dataset_name='MULTIALLEN_',
         cluster=False,
         print_info=False,
-        N=16):
-    """Main function for creating multiple datasets of cells."""
+        N=16,
+        prefetch_depth=1,
+        workers=1,
+        resume=None,
+        combo_samples=None,
+        combo_sampling='random',
+        estimate=False):
+    """Main function for creating multiple datasets of cells.
+
+    With workers > 1 datasets are encoded in a process pool and registered
+    here one at a time. Otherwise prefetch_depth datasets' cells are
+    queried in the background while the current dataset encodes (0 queries
+    each one inline). Per-dataset timings go to multi_exps/<ts>/.
+
+    Each dataset's progress is checkpointed in multi_exps/<ts>/ledger.json;
+    pass resume=<ts> to skip finished datasets and retry failed ones.
+
+    combo_samples limits each dataset to that many hp combos, drawn with
+    combo_sampling ('random' or 'lhs'; see iter_parameter_combos).
+
+    With estimate=True, only the queries and tiling are run and the
+    run's size and duration are predicted (see estimate_run)."""
     main_config = Allen_Brain_Observatory_Config()
 
     # Remove any BP-CC repos in the path
@@ -1389,10 +2230,11 @@ def build_multiple_datasets(
     if dataset_method['weight_sharing']:
         gridded_rfs, rf_size = create_grid_queries(all_data_dicts[0])
         if dataset_method['grid_query']:
-            all_data_dicts = query_neurons_rfs(
-                queries=gridded_rfs,
-                filter_by_stim=filter_by_stim,
-                sessions=sessions)
+            # Bin the cells we already have instead of querying each tile
+            tile_cells = assign_cells_to_tiles(all_data_dicts[0])
+            all_data_dicts = [
+                [all_data_dicts[0][idx] for idx in cells]
+                for cells in tile_cells]
             all_data_dicts = [
                 x for x in all_data_dicts if x != []]  # Filter empties.
         downsample = dataset_method[
@@ -1404,6 +2246,14 @@ def build_multiple_datasets(
     else:
         filter_size = None
 
+    if estimate:
+        if dataset_method['weight_sharing']:
+            tiles = all_data_dicts
+        else:
+            tiles = [[d] for q in all_data_dicts for d in q]
+        estimate_run(tiles, dataset_method, main_config, workers)
+        return
+
     # Declare the experiment template
     if dataset_method['st_conv']:
         # Dynamic dataset
@@ -1429,67 +2279,202 @@ def build_multiple_datasets(
     experiment_file = os.path.join(cc_path, 'experiments.py')
 
     # Loop through each query and build all possible datasets with template
-    ts = get_dt_stamp()
-    session_name = int(''.join(
-        [random.choice(string.digits) for k in range(N//2)]))
-    for ni, q in enumerate(all_data_dicts):
-        assert len(q), 'Cell dictionary is empty.'
-        meta_dir = os.path.join(
-            main_config.multi_exps,
-            '%s_cells_%s' % (len(q), ts))
-        make_dir(meta_dir)
-        if dataset_method['weight_sharing']:
-            print 'Preparing dataset %s/%s.' % (
-                ni,
-                len(all_data_dicts))
-            rf_grid = rf_extents(q)
-            rf_dict = q[0]
-            rf_dict['on_center_x_max'] = rf_grid['x_max']
-            rf_dict['on_center_y_max'] = rf_grid['y_max']
-            rf_dict['on_center_x'] = rf_grid['x_min']
-            rf_dict['on_center_y'] = rf_grid['y_min']
-            if 'this_dataset_name' in queries[ni][0].keys():
-                this_dataset_name = queries[ni][0]['this_dataset_name']
-            process_dataset(
-                dataset_method=dataset_method,
-                rf_dict=rf_dict,
-                this_dataset_name=this_dataset_name,
-                model_directory=model_directory,
-                model_templates=model_templates,
+    if resume is None:
+        ts = get_dt_stamp()
+    else:
+        ts = resume
+    run_dir = os.path.join(main_config.multi_exps, ts)
+    make_dir(run_dir)
+    timing_file = os.path.join(run_dir, 'timing.jsonl')
+    ledger = build_ledger.build_ledger(os.path.join(run_dir, 'ledger.json'))
+
+    # Cells in overlapping tiles are processed once and shared by the run
+    dataset_method['cell_cache_dir'] = os.path.join(run_dir, 'cell_cache')
+
+    if resume is None or not len(ledger.builds):
+        # List every dataset up front so they can be checkpointed, then
+        # prefetched or farmed out to workers
+        session_name = int(''.join(
+            [random.choice(string.digits) for k in range(N//2)]))
+        builds = []
+        for ni, q in enumerate(all_data_dicts):
+            assert len(q), 'Cell dictionary is empty.'
+            meta_dir = os.path.join(
+                main_config.multi_exps,
+                '%s_cells_%s' % (len(q), ts))
+            if dataset_method['weight_sharing']:
+                rf_grid = rf_extents(q)
+                # Copy, since overlapping tiles share their cell rows
+                rf_dict = dict(q[0])
+                rf_dict['on_center_x_max'] = rf_grid['x_max']
+                rf_dict['on_center_y_max'] = rf_grid['y_max']
+                rf_dict['on_center_x'] = rf_grid['x_min']
+                rf_dict['on_center_y'] = rf_grid['y_min']
+                if 'this_dataset_name' in queries[ni][0].keys():
+                    this_dataset_name = queries[ni][0]['this_dataset_name']
+                tile_rfs = [(ni, rf_dict)]
+            else:
+                tile_rfs = enumerate(q)
+            for idx, rf_dict in tile_rfs:
+                builds += [{
+                    'meta_dir': meta_dir,
+                    'job': {
+                        'rf_dict': rf_dict,
+                        'this_dataset_name': this_dataset_name,
+                        'method_name': draw_method_name(
+                            this_dataset_name,
+                            N),
+                        'idx': idx
+                    }
+                }]
+        ledger.queue(session_name, builds)
+    else:
+        print 'Resuming run %s: %s/%s datasets left.' % (
+            ts,
+            len(ledger.pending()),
+            len(ledger.builds))
+    session_name = ledger.session_name
+    pending = ledger.pending()
+    tile_dir = os.path.join(run_dir, 'tiles')
+    make_dir(tile_dir)
+    for bi in pending:
+        make_dir(ledger.builds[bi]['meta_dir'])
+
+    def tile_file(bi):
+        return os.path.join(tile_dir, '%s.pkl' % bi)
+
+    def tile_job(bi, data_dicts=None):
+        job = dict(ledger.builds[bi]['job'])
+        job.update(
+            dataset_method=dataset_method,
+            model_directory=model_directory,
+            model_templates=model_templates,
+            main_config=main_config,
+            data_dicts=data_dicts)
+        return job
+
+    # Builds that were encoded before a crash only need registering
+    to_encode = [bi for bi in pending if not os.path.exists(tile_file(bi))]
+    for bi in to_encode:
+        ledger.update(bi, 'encoding')
+    if workers > 1:
+        # Workers encode; this process is the only one writing shared state
+        pool = multiprocessing.Pool(workers, initializer=seed_worker)
+        encoded = pool.imap(
+            encode_tile_job,
+            [tile_job(bi) for bi in to_encode])
+    else:
+        query_method = copy.deepcopy(dataset_method)  # encode_tile mutates
+        tile_cells = data_db.prefetch(
+            [
+                functools.partial(
+                    prefetch_tile_cells,
+                    query_method,
+                    ledger.builds[bi]['job']['rf_dict'])
+                for bi in to_encode],
+            depth=prefetch_depth)
+        encoded = (
+            encode_tile_job(tile_job(bi, data_dicts))
+            for bi, data_dicts in it.izip(to_encode, tile_cells))
+    encoded = it.izip(to_encode, encoded)
+
+    def tiles():
+        """Checkpointed tiles first, then newly encoded ones."""
+        for bi in pending:
+            if bi not in to_encode:
+                yield bi, helper_funcs.load_object(tile_file(bi))
+        for bi, tile in encoded:
+            if 'error' in tile:
+                print 'Failed to encode dataset %s:\n%s' % (bi, tile['error'])
+                ledger.update(bi, 'failed', error=tile['error'])
+                continue
+            helper_funcs.save_object(tile, tile_file(bi))
+            ledger.update(bi, 'encoded', dataset_name=tile['dataset_name'])
+            yield bi, tile
+
+    for bi, tile in tiles():
+        start = time.time()
+        try:
+            registered = register_tile(
+                tile,
                 exps=exps,
                 template_experiment=template_experiment,
                 session_name=session_name,
-                meta_dir=meta_dir,
+                meta_dir=ledger.builds[bi]['meta_dir'],
                 db_config=credentials,  # db_config,
                 experiment_file=experiment_file,
-                main_config=main_config,
-                idx=ni,
                 cluster=cluster,
-                filter_size=filter_size,
-                exp_method_template=exp_method_template)
-        else:
-            for idx, rf_dict in enumerate(q):
-                print 'Preparing dataset %s/%s in package %s/%s.' % (
-                    idx,
-                    len(q),
-                    ni,
-                    len(all_data_dicts))
-                process_dataset(
-                    dataset_method=dataset_method,
-                    rf_dict=rf_dict,
-                    this_dataset_name=this_dataset_name,
-                    model_directory=model_directory,
-                    model_templates=model_templates,
+                exp_method_template=exp_method_template,
+                defer=True)
+        except Exception:
+            print 'Failed to register dataset %s:\n%s' % (
+                bi, traceback.format_exc())
+            ledger.update(bi, 'failed', error=traceback.format_exc())
+            continue
+        ledger.update(bi, 'registered' if registered else 'empty')
+        timing = {
+            'idx': bi,
+            'dataset_name': tile['dataset_name'],
+            'method_name': tile['method_name'],
+            'n_cells': len(tile['final_rf_dicts'] or []),
+            'registered': registered,
+            'encode_seconds': tile['encode_seconds'],
+            'register_seconds': time.time() - start
+        }
+        with open(timing_file, 'a') as f:
+            f.write(json.dumps(timing) + '\n')
+        print 'Finished dataset %s/%s (%s): encode %.1fs, register %.1fs.' % (
+            bi + 1,
+            len(ledger.builds),
+            tile['dataset_name'],
+            timing['encode_seconds'],
+            timing['register_seconds'])
+    if workers > 1:
+        pool.close()
+        pool.join()
+
+    # Insert the hp combos of every registered dataset not yet in the DB
+    # (including those from earlier attempts at this run) in one transaction
+    unpopulated = [
+        bi for bi, b in enumerate(ledger.builds)
+        if b['state'] == 'registered' and not b.get('populated', False)]
+    if len(unpopulated):
+        # Combos are streamed into the insert, one tile at a time
+        exp_combos = it.chain.from_iterable(
+            experiment_combos(
+                tile_experiment(
+                    helper_funcs.load_object(tile_file(bi)),
                     exps=exps,
                     template_experiment=template_experiment,
-                    session_name=session_name,
-                    meta_dir=meta_dir,
-                    db_config=credentials,  # db_config,
-                    experiment_file=experiment_file,
-                    main_config=main_config,
-                    idx=idx,
-                    cluster=cluster,
-                    exp_method_template=exp_method_template)
+                    session_name=session_name),
+                n_samples=combo_samples,
+                sampling=combo_sampling)
+            for bi in unpopulated)
+        # populate_db_batch raises (after rolling back) if the insert fails,
+        # so builds are only marked populated once it has committed
+        with allen_db(
+                cluster=cluster,
+                credentials=credentials) as db_conn:
+            n_combos = db_conn.populate_db_batch(exp_combos)
+        for bi in unpopulated:
+            ledger.update(bi, 'registered', populated=True)
+        print 'Inserted %s hp combos for %s datasets.' % (
+            n_combos,
+            len(unpopulated))
+
+    # Add every registered dataset's method (including those from earlier
+    # attempts at this run) to experiments.py in one write
+    added = add_experiments(
+        experiment_file,
+        exp_method_template,
+        ledger.experiment_names())
+    print 'Added %s experiment methods to %s.' % (len(added), experiment_file)
+    failed = [
+        bi for bi, b in enumerate(ledger.builds) if b['state'] == 'failed']
+    if len(failed):
+        print '%s datasets failed; rerun with --resume %s to retry them.' % (
+            len(failed),
+            ts)
 
 
 if __name__ == '__main__':
@@ -1504,5 +2489,64 @@ if __name__ == '__main__':
         dest='print_info',
         action='store_true',
         help='Print information on queried cells.')
-    args = parser.parse_args()
-    build_multiple_datasets(**vars(args))
+    parser.add_argument(
+        '--prefetch_depth',
+        dest='prefetch_depth',
+        type=int,
+        default=1,
+        help='Datasets to query ahead while encoding (0 to disable).')
+    parser.add_argument(
+        '--workers',
+        dest='workers',
+        type=int,
+        default=1,
+        help='Processes to encode datasets with.')
+    parser.add_argument(
+        '--resume',
+        dest='resume',
+        type=str,
+        default=None,
+        help='Timestamp of a run to resume (see multi_exps/<ts>/ledger.json).')
+    parser.add_argument(
+        '--combo_samples',
+        dest='combo_samples',
+        type=int,
+        default=None,
+        help='Hp combos to sample per dataset (default: the full grid).')
+    parser.add_argument(
+        '--combo_sampling',
+        dest='combo_sampling',
+        type=str,
+        default='random',
+        choices=['random', 'lhs'],
+        help='How to sample hp combos with --combo_samples.')
+    parser.add_argument(
+        '--estimate',
+        dest='estimate',
+        action='store_true',
+        help='Predict the run\'s size and duration without encoding.')
+    parser.add_argument(
+        '--create_queue_indexes',
+        dest='create_queue_indexes',
+        action='store_true',
+        help='Create the indexes experiment reservation relies on.')
+    parser.add_argument(
+        '--benchmark_reservations',
+        dest='benchmark_reservations',
+        type=int,
+        default=0,
+        help='Benchmark experiment reservation with this many workers.')
+    args = vars(parser.parse_args())
+    benchmark_workers = args.pop('benchmark_reservations')
+    if args.pop('create_queue_indexes'):
+        with allen_db(
+                cluster=args['cluster'],
+                credentials=credentials) as db_conn:
+            db_conn.create_queue_indexes()
+    elif benchmark_workers:
+        benchmark_reservations(
+            credentials,
+            workers=benchmark_workers,
+            cluster=args['cluster'])
+    else:
+        build_multiple_datasets(**args)
@@ -3,6 +3,7 @@
 import os
 import gc
 import cv2
+import hashlib
 import argparse
 import numpy as np
 import tensorflow as tf
@@ -10,14 +11,13 @@ import cPickle as pickle
 from data_db import data_db
 from glob import glob
 from tqdm import tqdm
-from scipy import stats, misc
-from sklearn import linear_model
+from scipy import misc
 # from declare_datasets import declare_allen_datasets as dad
 from declare_datasets_loop import declare_allen_datasets as dad
 from allen_config import Allen_Brain_Observatory_Config as Config
 from allensdk.brain_observatory import stimulus_info
 from utils.py_utils import flatten_list
-from ops import helper_funcs, deconvolve
+from ops import helper_funcs, deconvolve, build_manifest, cell_cache
 # from deconv_methods import eval_resnet
 # try:
 #     from ops import helper_funcs, deconvolve
@@ -136,7 +136,96 @@ def fix_malformed_pointers(d, filter_ext='.npy', rep_ext='.npz'):
     return d
 
 
+def align_neural_traces(
+        neural_data,
+        stim_table,
+        neural_delay,
+        st_conv=False,
+        timecourse='final'):
+    """Align a (cells x time) trace matrix to stimulus onsets.
+
+    All delayed samples are gathered with a single fancy-indexing
+    operation into a (cells x events x delays) array, which is then
+    averaged or reduced to its final timestep. Returns the labels and the
+    stim_table indices of the triggering event."""
+    neural_data = np.atleast_2d(neural_data)
+    onsets = stim_table[:, 1]
+    if isinstance(neural_delay, list):
+        # Average events
+        slice_inds = np.arange(neural_delay[0], neural_delay[1])
+        trimmed = neural_data[:, onsets[:, None] + slice_inds[None, :]]
+        # Use the first event in stim_table as the triggering event
+        stim_table_idx = onsets + slice_inds[0]
+        if st_conv:
+            if timecourse == 'all':
+                # Take all activity
+                # TODO unclear how this works with weight sharing
+                pass
+            elif timecourse == 'final':
+                # Take the final timestep of activity for a ST model
+                trimmed = trimmed[:, :, -1]
+            elif timecourse == 'mean':
+                # Take the mean of activity for a ST model
+                trimmed = trimmed.mean(-1)
+            else:
+                raise NotImplementedError
+        else:
+            # Average across neural events
+            trimmed = trimmed.mean(-1)
+    else:
+        # Constant offset
+        stim_table_idx = onsets + neural_delay
+        trimmed = neural_data[:, stim_table_idx]
+    return trimmed, stim_table_idx
+
+
+def detrend_traces(traces):
+    """Remove a linear trend from every row of a (cells x events) matrix.
+
+    Slopes and intercepts for all cells come from one least-squares solve
+    against a shared [t, 1] design matrix."""
+    traces = np.atleast_2d(traces)
+    timesteps = np.arange(traces.shape[-1], dtype=np.float64)
+    design = np.stack((timesteps, np.ones_like(timesteps)), axis=1)
+    coefs = np.linalg.lstsq(design, traces.transpose(), rcond=-1)[0]
+    return traces - design.dot(coefs).transpose()
+
+
 # @profile
+def stimulus_frames(proc_stimuli, exp_dict):
+    """Stimulus frames for a dataset, stacked over time for st_conv."""
+    if not exp_dict['st_conv']:
+        return proc_stimuli
+    timesteps = len(
+        range(
+            exp_dict['neural_delay'][0], exp_dict['neural_delay'][1]))
+    stim_len = len(proc_stimuli)
+    st_array = np.zeros((
+            stim_len,
+            timesteps,
+            proc_stimuli.shape[1],
+            proc_stimuli.shape[2],
+            proc_stimuli.shape[3]),
+        dtype=np.float32)
+    for idx in tqdm(
+            range(stim_len),
+            desc='Processing spatiotemporal array'):
+        count = 0
+        if (idx + timesteps) >= stim_len:
+            ep = idx + (stim_len - idx)  # How many can we add.
+            for x in xrange(idx, ep):
+                st_array[idx, count, :, :, :] = proc_stimuli[x]
+                count += 1
+            for x in xrange(timesteps - (stim_len - idx)):
+                st_array[idx, count, :, :, :] = proc_stimuli[idx]
+                count += 1
+        else:
+            for x in xrange(idx, idx + timesteps):
+                st_array[idx, count, :, :, :] = proc_stimuli[x]
+                count += 1
+    return st_array  # TODO: OPTIMIZE
+
+
 def process_body(
         d,
         exp_dict,
@@ -160,38 +249,9 @@ def process_body(
     # Stimuli
     df['stimulus_name'] = cell_data['stim_template'].item()
     if proc_stimuli:
-        proc_stimuli = all_stimuli[df['stimulus_name']]['processed']
-        if exp_dict['st_conv']:
-            timesteps = len(
-                range(
-                    exp_dict['neural_delay'][0], exp_dict['neural_delay'][1]))
-            stim_len = len(proc_stimuli)
-            st_array = np.zeros((
-                    stim_len,
-                    timesteps,
-                    proc_stimuli.shape[1],
-                    proc_stimuli.shape[2],
-                    proc_stimuli.shape[3]),
-                dtype=np.float32)
-            for idx in tqdm(
-                    range(stim_len),
-                    desc='Processing spatiotemporal array'):
-                count = 0
-                if (idx + timesteps) >= stim_len:
-                    ep = idx + (stim_len - idx)  # How many can we add.
-                    for x in xrange(idx, ep):
-                        st_array[idx, count, :, :, :] = proc_stimuli[x]
-                        count += 1
-                    for x in xrange(timesteps - (stim_len - idx)):
-                        st_array[idx, count, :, :, :] = proc_stimuli[idx]
-                        count += 1
-                else:
-                    for x in xrange(idx, idx + timesteps):
-                        st_array[idx, count, :, :, :] = proc_stimuli[x]
-                        count += 1
-            df['proc_stimuli'] = st_array  # TODO: OPTIMIZE
-        else:
-            df['proc_stimuli'] = proc_stimuli
+        df['proc_stimuli'] = stimulus_frames(
+            all_stimuli[df['stimulus_name']]['processed'],
+            exp_dict)
     else:
         df['proc_stimuli'] = None
 
@@ -222,53 +282,20 @@ def process_body(
         neural_data = spike_prediction
 
     # Delay data with 'neural_delay'
-    if isinstance(exp_dict['neural_delay'], list):
-        # Average events
-        slice_inds = range(
-            exp_dict['neural_delay'][0],
-            exp_dict['neural_delay'][1])
-        neural_data_trimmed = np.zeros((
-            len(slice_inds),
-            len(stim_table[:, 1])))
-        for idx in range(len(slice_inds)):
-            it_stim_table_idx = stim_table[:, 1] + slice_inds[idx]
-            neural_data_trimmed[idx] = neural_data[it_stim_table_idx]
-        # Use the first event in stim_table as the triggering event
-        stim_table_idx = stim_table[:, 1] + slice_inds[0]
-        if exp_dict['st_conv']:
-            if exp_dict['timecourse'] == 'all':
-                # Take all activity
-                neural_data_trimmed = neural_data_trimmed.transpose()
-                import ipdb
-                ipdb.set_trace()
-                # TODO unclear how this works with weight sharing
-            elif exp_dict['timecourse'] == 'final':
-                # Take the final timestep of activity for a ST model
-                neural_data_trimmed = neural_data_trimmed.transpose()[:, -1]
-            elif exp_dict['timecourse'] == 'mean':
-                # Take the mean of activity for a ST model
-                neural_data_trimmed = neural_data_trimmed.transpose().mean(1)
-            else:
-                raise NotImplementedError
-        else:
-            # Average across neural events
-            neural_data_trimmed = neural_data_trimmed.mean(0)
-    else:
+    if not isinstance(exp_dict['neural_delay'], list):
         # Constant offset
         print 'Using constant offset of %s events.' % exp_dict['neural_delay']
-        stim_table_idx = stim_table[:, 1] + exp_dict['neural_delay']
-        neural_data_trimmed = neural_data[stim_table_idx]
+    neural_data_trimmed, stim_table_idx = align_neural_traces(
+        neural_data=neural_data[None, :],
+        stim_table=stim_table,
+        neural_delay=exp_dict['neural_delay'],
+        st_conv=exp_dict['st_conv'],
+        timecourse=exp_dict['timecourse'])
     if exp_dict['detrend']:
         assert not exp_dict['st_conv'],\
             'Detrending not implemented for ST data.'
-        regr = linear_model.LinearRegression()
-        model = regr.fit(
-            np.arange(len(neural_data_trimmed)).reshape(-1, 1),
-            neural_data_trimmed)
-        neural_data_trimmed = neural_data_trimmed.reshape(
-            -1) - model.predict(
-                neural_data_trimmed.reshape(-1, 1)).reshape(-1)
-        neural_data_trimmed = neural_data_trimmed.reshape(-1)
+        neural_data_trimmed = detrend_traces(neural_data_trimmed)
+    neural_data_trimmed = neural_data_trimmed[0]
     df['neural_trace_trimmed'] = neural_data_trimmed
 
     # ROI mask
@@ -365,8 +392,11 @@ def get_stim_names_and_orders(data_dicts):
     return stim_orders, stim_names
 
 
-def preload_raw_stimuli(data_dicts, exp_dict):
-    """Preload all stimuli to save memory."""
+def preload_raw_stimuli(data_dicts, exp_dict, cache=None):
+    """Preload all stimuli to save memory.
+
+    With a cell_cache, processed stimuli are memory-mapped from the cache
+    and only stimuli missing from it are loaded and processed."""
     stim_orders, stim_names = get_stim_names_and_orders(data_dicts)
     np_stim_names = np.asarray(stim_names)
 
@@ -410,6 +440,15 @@ def preload_raw_stimuli(data_dicts, exp_dict):
             unique_stimuli,
             total=len(unique_stimuli),
             desc='Loading stimuli into memory'):
+        if cache is not None:
+            stim_key = build_manifest.hash_inputs(
+                stim,
+                unique_orders[stim],
+                stimulus_params(exp_dict))
+            processed = cache.load_stimulus(stim_key)
+            if processed is not None:
+                all_stimuli[stim] = {'processed': processed}
+                continue
         raw_stimuli = np.load(stim).astype(exp_dict['image_type'])
         if exp_dict['warp_stimuli']:
             # Apply warping to stimuli
@@ -446,24 +485,66 @@ def preload_raw_stimuli(data_dicts, exp_dict):
         if len(raw_stimuli.shape) < 4:
             # Ensure that stimuli are a 4D tensor.
             raw_stimuli = np.expand_dims(raw_stimuli, axis=-1)
+        processed = raw_stimuli[unique_orders[stim]]
+        if cache is not None:
+            processed = cache.save_stimulus(stim_key, processed)
         all_stimuli[stim] = {
             # 'raw': raw_stimuli,
-            'processed': raw_stimuli[unique_orders[stim]]
+            'processed': processed
         }
     return all_stimuli
 
 
+def stimulus_params(exp_dict):
+    """Subset of exp_dict that changes how stimuli are processed."""
+    return {
+        k: get_field(exp_dict, k, None) for k in [
+            'image_type',
+            'warp_stimuli',
+            'process_stimuli']}
+
+
+def cell_params(exp_dict, stimuli_key, neural_key):
+    """Subset of exp_dict that changes how one cell is processed."""
+    params = {
+        k: get_field(exp_dict, k, None) for k in [
+            'neural_delay',
+            'st_conv',
+            'timecourse',
+            'detrend',
+            'data_type',
+            'image_type',
+            'deconv_method',
+            'include_targets']}
+    params['stimuli_key'] = stimuli_key
+    params['neural_key'] = neural_key
+    return params
+
+
 def process_cell_data(
         data_dicts,
         exp_dict,
         stimuli_key,
         neural_key):
-    """Loop for processing cell data."""
+    """Loop for processing cell data.
+
+    If exp_dict has a cell_cache_dir, processed cells and stimuli are
+    shared through a cell_cache so that cells in several (overlapping)
+    datasets of a run are only processed once."""
     # deconv = deconvolve.deconvolve(exp_dict)
     deconv = None
+    cache_dir = get_field(exp_dict, 'cell_cache_dir', None)
+    if cache_dir is not None:
+        cache = cell_cache.cell_cache(cache_dir)
+        params = cell_params(exp_dict, stimuli_key, neural_key)
+    else:
+        cache = None
 
     # Preprocess raw_stimuli
-    all_stimuli = preload_raw_stimuli(data_dicts=data_dicts, exp_dict=exp_dict)
+    all_stimuli = preload_raw_stimuli(
+        data_dicts=data_dicts,
+        exp_dict=exp_dict,
+        cache=cache)
 
     # Variables
     key_list = []
@@ -473,6 +554,31 @@ def process_cell_data(
             enumerate(data_dicts),
             total=len(data_dicts),
             desc='Preparing data'):
+        if cache is not None:
+            cell_key = build_manifest.hash_inputs(d, params)
+            df = cache.load_cell(cell_key)
+            if df is None:
+                df = cache.save_cell(
+                    cell_key,
+                    process_body(
+                        d=d,
+                        exp_dict=exp_dict,
+                        stimuli_key=stimuli_key,
+                        neural_key=neural_key,
+                        deconv=deconv,
+                        all_stimuli=all_stimuli,
+                        proc_stimuli=False))
+            it_stim_name = df['stimulus_name']
+            if it_stim_name not in stim_names:
+                # Only attach stimuli to the first cell that shows them
+                if 'image' in df:
+                    df['image'] = stimulus_frames(
+                        all_stimuli[it_stim_name]['processed'],
+                        exp_dict)
+                stim_names += [it_stim_name]
+            output_data += [df]
+            key_list += [[k for k, v in df.iteritems() if v is not None]]
+            continue
         it_stim_name = load_cell_meta(d)['stim_template'].item()
         if it_stim_name not in stim_names:
             # Only prepare stimuli once
@@ -511,6 +617,27 @@ def load_npzs(
         neural_key=None,
         check_stimuli=False):
     """Load cell data from an npz."""
+    output_data, output_rfs, cell_list = load_cell_data(
+        data_dicts=data_dicts,
+        exp_dict=exp_dict,
+        stimuli_key=stimuli_key,
+        neural_key=neural_key,
+        check_stimuli=check_stimuli)
+
+    # Concatenate data into equal-sized lists
+    event_dict = package_events(
+        output_data=output_data,
+        exp_dict=exp_dict)
+    return event_dict, output_rfs, cell_list
+
+
+def load_cell_data(
+        data_dicts,
+        exp_dict,
+        stimuli_key=None,
+        neural_key=None,
+        check_stimuli=False):
+    """Load and consolidate cell data before it is split into events."""
 
     # Organize data_dicts by cell
     cell_specimen_ids = [d['cell_specimen_id'] for d in data_dicts]
@@ -577,176 +704,163 @@ def load_npzs(
     # TODO: handle NaNs in output_data here.
     if exp_dict['cc_repo_vars']['output_size'][0] > 0:  # 1:
         # Multi neuron target; consolidate event_dict.
-        stimuli = [d['stimulus_name'] for d in output_data]
-        unique_stimuli, ri = np.unique(
-            stimuli,
-            return_index=True)
-
-        # Concatenate image/labels appropriately.
-        labels = {}
-        ROImasks = {}
-        images = {}
-        cell_specimen_ids = {}
-        for stim in zip(unique_stimuli):
-            stim = stim[0]
-            labels[stim] = []
-            ROImasks[stim] = []
-            images[stim] = []
-            cell_specimen_ids[stim] = []
-            for d, rd in zip(output_data, data_dicts):
-                if d['stimulus_name'] == stim:
-                    # Concatenate additional cells across the 2nd dimension
-                    labels[stim] += [np.expand_dims(d['label'], axis=1)]
-                    ROImasks[stim] += [np.expand_dims(d['ROImask'], axis=0)]
-                    if d['image'] is not None:
-                        # TODO: Check that neurons and stimuli are aligned.
-                        images[stim] += [d['image']]
-                    cell_specimen_ids[stim] += [d['cell_specimen_id']]
-
-        # Process dicts for cells
-        cat_labels = {}
-        cat_ROImasks = {}
-        cat_images = {}
-        cat_repeats = {}
-        cat_events = {}
-        cat_cell_specimen_ids = {}
-        for stim in unique_stimuli:
-            cells = np.asarray(cell_specimen_ids[stim])
-            unique_cells = np.unique(cells)
-            cat_cell_specimen_ids[stim] = unique_cells
-
-            # Count the floor number of times each cell was recorded
-            count_cells = cells - cells.min()
-            cell_bins = np.bincount(count_cells)
-            cell_floor = cell_bins[cell_bins > 0].min()
-
-            # Concatenate cells up to cell_floor times
-            for cell_count, cell in enumerate(unique_cells):
-                cell_ids = np.where(cells == cell)[0][:cell_floor]
-                for cell_it, ci in enumerate(cell_ids):
-                    if exp_dict['st_conv']:
-                        it_images = images[stim][0]
-                    else:
-                        it_images = images[stim][ci]
-                    if cell_it == 0:
-                        cell_labels = labels[stim][ci]
-                        cell_images = it_images
-                        cell_ROImasks = ROImasks[stim][ci]
-                        cell_events = np.arange(len(cell_labels))
-                        cell_repeats = np.ones(len(cell_labels)) * cell_it
-                    else:
-                        cell_labels = np.concatenate(
-                            (
-                                cell_labels,
-                                labels[stim][ci]),
-                            axis=0)
-                        cell_images = np.concatenate(
-                            (
-                                cell_images,
-                                it_images),
-                            axis=0)
-                        cell_events = np.concatenate(
-                            (
-                                cell_events,
-                                np.arange(len(cell_labels))),
-                            axis=0)
-                        cell_repeats = np.concatenate(
-                            (
-                                cell_repeats,
-                                np.ones(len(cell_labels)) * cell_it),
-                            axis=0)
-                if cell_count == 0:
-                    cat_labels[stim] = cell_labels
-                    cat_ROImasks[stim] = cell_ROImasks
-                    cat_images[stim] = cell_images
-                    cat_events[stim] = cell_events
-                    cat_repeats[stim] = cell_repeats
-                else:
-                    # Concatenate cells across dimensions
-                    cat_labels[stim] = np.concatenate(
-                        (
-                            cat_labels[stim],
-                            cell_labels
-                        ),
-                        axis=1)
-
-                    # Masks are inconsistently sized
-                    pad_offset = np.abs(
-                        np.asarray(
-                            cat_ROImasks[stim].shape[1:3]) - np.asarray(
-                            cell_ROImasks.shape[1:3]))
-
-                    if np.any(pad_offset):
-                        # Add padding -- This isn't correctly aligning cells.
-                        cell_ROImasks = cv2.copyMakeBorder(
-                            cell_ROImasks.squeeze(),
-                            pad_offset[0],
-                            0,
-                            pad_offset[1],
-                            0,
-                            cv2.BORDER_CONSTANT,
-                            0)[None, :, :, None]
-                    cat_ROImasks[stim] = np.concatenate(
-                        (
-                            cat_ROImasks[stim],
-                            cell_ROImasks
-                        ),
-                        axis=0)
-
-        # Test for aligned cells across sessions
-        # import ipdb;ipdb.set_trace()  TODO: FIX THIS FOR SCENES
-        test_cells = np.concatenate(
-            [np.expand_dims(x, axis=-1)
-                for x in cat_cell_specimen_ids.values()],
-            axis=-1)
-        assert test_cells.var(-1).sum() == 0, 'Cell IDs are not aligned.'
-
-        # Prepare meta rf dict
-        cell_list = test_cells[:, 0]
-        output_rfs = {}
-        for ce in cell_list:
-            dict_list = []
-            for d in data_dicts:
-                if d['cell_specimen_id'] == ce:
-                    dict_list += [d]
-            output_rfs[ce] = dict_list
-
-        # Package into a list of dicts.
-        output_data = []
-        for (ik, iv), (lk, lv), (rk, rv), (ck, cv), (pk, pv), (ek, ev) in zip(
-                cat_images.iteritems(),
-                cat_labels.iteritems(),
-                cat_ROImasks.iteritems(),
-                cat_cell_specimen_ids.iteritems(),
-                cat_repeats.iteritems(),
-                cat_events.iteritems()):
-            assert ik == lk == rk == ck == pk == ek, 'Issue with keys.'
-            if exp_dict['slice_frames'] is not None:
-                iv = iv[range(0, len(iv), exp_dict['slice_frames'])]
-                lv = lv[range(0, len(lv), exp_dict['slice_frames'])]
-                rv = rv[range(0, len(rv), exp_dict['slice_frames'])]
-                pv = pv[range(0, len(pv), exp_dict['slice_frames'])]
-                ev = ev[range(0, len(ev), exp_dict['slice_frames'])]
-            output_data += [{
-                'image': iv,
-                'cell_specimen_id': cv,
-                'ROImask': rv,
-                'label': lv,
-                'stimulus_name': ik,
-                'stimulus_iterations': pv,
-                'event_index': ev,
-            }]
+        output_data, output_rfs, cell_list = consolidate_cells(
+            output_data=output_data,
+            data_dicts=data_dicts,
+            exp_dict=exp_dict)
+    return output_data, output_rfs, cell_list
+
+
+def consolidate_cells(output_data, data_dicts, exp_dict):
+    """Consolidate per-cell data into one multi-neuron entry per stimulus.
+
+    Label, event and repeat arrays are preallocated at their final size.
+    Stimulus frames are stored once per stimulus and referenced per event
+    through a frame_index array instead of being copied for every repeat.
+    """
+    stimuli = [d['stimulus_name'] for d in output_data]
+    unique_stimuli = np.unique(stimuli)
+
+    # Gather labels/masks per stimulus and keep one reference to its frames.
+    labels = {stim: [] for stim in unique_stimuli}
+    ROImasks = {stim: [] for stim in unique_stimuli}
+    images = {stim: None for stim in unique_stimuli}
+    cell_specimen_ids = {stim: [] for stim in unique_stimuli}
+    for d in output_data:
+        stim = d['stimulus_name']
+        labels[stim] += [d['label']]
+        ROImasks[stim] += [np.expand_dims(d['ROImask'], axis=0)]
+        if images[stim] is None and d['image'] is not None:
+            # TODO: Check that neurons and stimuli are aligned.
+            images[stim] = d['image']
+        cell_specimen_ids[stim] += [d['cell_specimen_id']]
+
+    # Process dicts for cells
+    cat_labels = {}
+    cat_ROImasks = {}
+    cat_images = {}
+    cat_frames = {}
+    cat_repeats = {}
+    cat_events = {}
+    cat_cell_specimen_ids = {}
+    for stim in unique_stimuli:
+        cells = np.asarray(cell_specimen_ids[stim])
+        unique_cells = np.unique(cells)
+        cat_cell_specimen_ids[stim] = unique_cells
+
+        # Count the floor number of times each cell was recorded
+        count_cells = cells - cells.min()
+        cell_bins = np.bincount(count_cells)
+        cell_floor = cell_bins[cell_bins > 0].min()
+
+        # Fill (repeats * events, cells) labels up to cell_floor repeats
+        num_events = len(labels[stim][0])
+        it_labels = np.zeros(
+            (cell_floor * num_events, len(unique_cells)),
+            dtype=labels[stim][0].dtype)
+        it_ROImasks = []
+        for cell_count, cell in enumerate(unique_cells):
+            cell_ids = np.where(cells == cell)[0][:cell_floor]
+            for cell_it, ci in enumerate(cell_ids):
+                assert len(labels[stim][ci]) == num_events,\
+                    'Found cells with different event counts for %s.' % stim
+                it_labels[
+                    cell_it * num_events:(cell_it + 1) * num_events,
+                    cell_count] = labels[stim][ci]
+            cell_ROImasks = ROImasks[stim][cell_ids[0]]
+            if cell_count > 0:
+                # Masks are inconsistently sized
+                pad_offset = np.abs(
+                    np.asarray(
+                        it_ROImasks[0].shape[1:3]) - np.asarray(
+                        cell_ROImasks.shape[1:3]))
+                if np.any(pad_offset):
+                    # Add padding -- This isn't correctly aligning cells.
+                    cell_ROImasks = cv2.copyMakeBorder(
+                        cell_ROImasks.squeeze(),
+                        pad_offset[0],
+                        0,
+                        pad_offset[1],
+                        0,
+                        cv2.BORDER_CONSTANT,
+                        0)[None, :, :, None]
+            it_ROImasks += [cell_ROImasks]
+
+        # Every repeat shows the same stimulus, so index into shared frames
+        cat_labels[stim] = it_labels
+        cat_ROImasks[stim] = np.concatenate(it_ROImasks, axis=0)
+        cat_images[stim] = images[stim]
+        cat_events[stim] = np.tile(np.arange(num_events), cell_floor)
+        cat_frames[stim] = cat_events[stim].copy()
+        cat_repeats[stim] = np.repeat(
+            np.arange(cell_floor), num_events).astype(np.float64)
+
+    # Test for aligned cells across sessions
+    # import ipdb;ipdb.set_trace()  TODO: FIX THIS FOR SCENES
+    test_cells = np.concatenate(
+        [np.expand_dims(x, axis=-1)
+            for x in cat_cell_specimen_ids.values()],
+        axis=-1)
+    assert test_cells.var(-1).sum() == 0, 'Cell IDs are not aligned.'
+
+    # Prepare meta rf dict
+    cell_list = test_cells[:, 0]
+    output_rfs = {ce: [] for ce in cell_list}
+    for d in data_dicts:
+        if d['cell_specimen_id'] in output_rfs:
+            output_rfs[d['cell_specimen_id']] += [d]
 
-    # Concatenate data into equal-sized lists
+    # Package into a list of dicts.
+    output_data = []
+    for stim in unique_stimuli:
+        lv = cat_labels[stim]
+        rv = cat_ROImasks[stim]
+        pv = cat_repeats[stim]
+        ev = cat_events[stim]
+        fv = cat_frames[stim]
+        if exp_dict['slice_frames'] is not None:
+            lv = lv[range(0, len(lv), exp_dict['slice_frames'])]
+            rv = rv[range(0, len(rv), exp_dict['slice_frames'])]
+            pv = pv[range(0, len(pv), exp_dict['slice_frames'])]
+            ev = ev[range(0, len(ev), exp_dict['slice_frames'])]
+            fv = fv[range(0, len(fv), exp_dict['slice_frames'])]
+        output_data += [{
+            'image': cat_images[stim],
+            'frame_index': fv,
+            'cell_specimen_id': cat_cell_specimen_ids[stim],
+            'ROImask': rv,
+            'label': lv,
+            'stimulus_name': stim,
+            'stimulus_iterations': pv,
+            'event_index': ev,
+        }]
+    return output_data, output_rfs, cell_list
+
+
+def package_events(output_data, exp_dict):
+    """Split consolidated data into a list of per-event dicts.
+
+    When an entry carries a frame_index, each event's image is a view into
+    the shared stimulus frames rather than a copy.
+    """
     event_dict = []
     for d in output_data:
-        ref_length = d['image'].shape[0]
-        assert ref_length == d['label'].shape[0],\
-            'Stimuli and neural data do not match.'
+        frame_index = get_field(d, 'frame_index', None)
+        ref_length = d['label'].shape[0]
+        if frame_index is None:
+            assert ref_length == d['image'].shape[0],\
+                'Stimuli and neural data do not match.'
+        else:
+            assert ref_length == len(frame_index),\
+                'Stimuli and neural data do not match.'
         for idx in range(ref_length):
             it_event = {}
             for k, v in d.iteritems():
-                if exp_dict['include_targets'][k] == 'split':
+                if k == 'frame_index':
+                    continue
+                elif k == 'image' and frame_index is not None:
+                    it_event[k] = v[frame_index[idx]]
+                elif exp_dict['include_targets'][k] == 'split':
                     try:
                         it_event[k] = v[idx]
                     except:
@@ -758,7 +872,7 @@ def load_npzs(
                     raise RuntimeError(
                         'Fucked up packing data into list of dicts.')
             event_dict += [it_event]
-    return event_dict, output_rfs, cell_list
+    return event_dict
 
 
 def create_example(data_dict, feature_types):
@@ -820,8 +934,13 @@ def prepare_data_for_tf_records(
         cc_repo=None,
         stimuli_key=None,
         ext='tfrecords',
-        config=None):
-    """Package dict into tfrecords."""
+        config=None,
+        manifest=None,
+        data_key=None):
+    """Package dict into tfrecords.
+
+    With a build_manifest, each fold and the data loader are only
+    rewritten when their input hashes change."""
     # TODO: MOVE SLICEING HERE
     if cv_split.keys()[0] == 'random_cv_split':
         cv_inds = np.random.permutation(len(data_files))
@@ -891,6 +1010,10 @@ def prepare_data_for_tf_records(
     else:
         raise RuntimeError(
             'Selected crossvalidation %s is not yet implemented.' % cv_split)
+    fold_inds = {
+        'train': train_ind,
+        'val': val_ind
+    }
 
     if isinstance(store_means, tuple):
         print 'Converting tuple store_means to a list.'
@@ -902,8 +1025,21 @@ def prepare_data_for_tf_records(
         it_name = os.path.join(
             output_directory,
             '%s_%s.%s' % (set_name, k, ext))
+        mean_file = os.path.join(
+            output_directory,
+            '%s_%s_means' % (set_name, k))
         idx = 0
         assert len(v) > 0, 'Empty validation set found.'
+        fold_stage = 'encode_%s' % k
+        fold_key = build_manifest.hash_inputs(
+            data_key,
+            k,
+            fold_inds[k],
+            store_means,
+            feature_types)
+        if manifest is not None and manifest.unchanged(fold_stage, fold_key):
+            print 'Fold %s is unchanged: %s' % (k, it_name)
+            continue
         with tf.python_io.TFRecordWriter(it_name) as tfrecord_writer:
             for idx, d in tqdm(
                     enumerate(v),
@@ -939,9 +1075,6 @@ def prepare_data_for_tf_records(
                     stds[imk] = np.std(data_vol)
                 else:
                     stds[imk] = 1.
-        mean_file = os.path.join(
-            output_directory,
-            '%s_%s_means' % (set_name, k))
         num_its = float(len(v))
 
         # Store means in a dictionary
@@ -952,11 +1085,17 @@ def prepare_data_for_tf_records(
             } for k, v in means.iteritems() if not isinstance(v, list)}
         np.savez(mean_file, means)
         print 'Finished encoding: %s' % it_name
+        if manifest is not None:
+            manifest.record(
+                fold_stage,
+                fold_key,
+                [it_name, '%s.npz' % mean_file])
 
     # Save file containing info about the stimuli (i.e. X for X -> Y)
     meta_file = os.path.join(
         output_directory,
         '%s_meta' % (set_name))
+    d = v[0]
     im_size = d[stimuli_key.values()[0]].shape
     tf_load_vars = prepare_tf_dicts(feature_types, d)
     tf_reader = {}
@@ -997,10 +1136,18 @@ def prepare_data_for_tf_records(
         }
 
         # Create data loader for contextual circuit BP
-        create_data_loader_class(
-            template_file=cc_repo['template_file'],
-            meta_dict=loader_meta,
-            output_file=dl_file)
+        loader_key = build_manifest.hash_inputs(
+            loader_meta,
+            cc_repo['template_file'])
+        if manifest is not None and manifest.unchanged('loader', loader_key):
+            print 'Data loader is unchanged: %s' % dl_file
+        else:
+            create_data_loader_class(
+                template_file=cc_repo['template_file'],
+                meta_dict=loader_meta,
+                output_file=dl_file)
+            if manifest is not None:
+                manifest.record('loader', loader_key, [dl_file])
 
         # Create models for contextual circuit BP
         # summarized_rfs = summarize_rfs(rf_dicts)
@@ -1018,18 +1165,13 @@ def summarize_rfs(
         y_key='on_center_y',
         k_key='on_width_x'):
     """Return the averages of RF centroids and extents."""
-    xs, ys, ks = [], [], []
-    for k, v in rf_dicts.iteritems():
-        v = v[0]
-        if v[x_key] is not None:
-            xs += [v[x_key]]
-        if v[y_key] is not None:
-            ys += [v[y_key]]
-        if v[k_key] is not None:
-            ks += [v[k_key]]
-    h = np.nanmean(ys)
-    w = np.nanmean(xs)
-    k = np.nanmean(ks)
+    rfs = data_db.dicts_to_columns(
+        [v[0] for v in rf_dicts.values()],
+        [x_key, y_key, k_key])
+    # Missing (None) values are NaN in the columns and ignored here
+    h = np.nanmean(rfs[y_key].astype(np.float64))
+    w = np.nanmean(rfs[x_key].astype(np.float64))
+    k = np.nanmean(rfs[k_key].astype(np.float64))
     assert h != 0, 'No RF height found.'
     assert w != 0, 'No RF width found.'
     assert k != 0, 'No RF kernel found.'
@@ -1065,89 +1207,166 @@ def inclusive_cell_filter(data_dicts, sessions):
     return filtered_data_dicts
 
 
-def inclusive_stim_order_filter(data_dicts):
-    """Filter data for cells that have inconsistent stimuli lists."""
-    # Find unique stimuli
-    stim_orders, stim_names = get_stim_names_and_orders(
-        data_dicts)
+def order_fingerprint(order):
+    """Hash a stimulus order vector (including its length) to a string."""
+    order = np.ascontiguousarray(order, dtype=np.float64)
+    return hashlib.md5(
+        str(order.shape) + order.tostring()).hexdigest()
 
-    # Concatenate orders per stimulus
-    np_stim_names = np.asarray(stim_names)
-    np_stim_orders = np.asarray(stim_orders)
-    unique_stimuli = np.unique(stim_names)
-    if len(unique_stimuli) == 1 and 'scenes' in unique_stimuli[0]:
-        # Handle scenes differently from movies (Find identical orders).
-        dm = np.corrcoef(np_stim_orders)
-        best_order_counts = np.argmax((np.tril(dm, -1) == 1).sum(1))
-        filter_ids = [idx for idx, k in enumerate(
-            np_stim_orders) if not np.all(
-            k == np_stim_orders[best_order_counts])]
-    else:
-        filter_list = []
-        for stim in unique_stimuli:
-            # Loop through stimuli
-            stim_idx = np.where(np.asarray(stim) == np_stim_names)[0]
-            it_orders = np_stim_orders[stim_idx]
-            mat_orders = np.asarray(
-                [x.tolist() for x in it_orders]).transpose()
-            for order in mat_orders:
-                # Loop through order indices
-                modal = stats.mode(order)[0][0]
-                filter_list += [np.where(order != modal)[0]]
-        filter_ids = np.unique(np.concatenate(filter_list))
-
-    # Find unique indices
-    filtered_data_dicts = [d for idx, d in enumerate(
-        data_dicts) if idx not in filter_ids]
+
+def inclusive_stim_order_filter(data_dicts):
+    """Filter data for cells that have inconsistent stimuli lists.
+
+    Every cell's order vector is hashed into a fingerprint. Cells are
+    grouped per stimulus and only those matching that stimulus' modal
+    fingerprint are kept, which is linear in the number of cells.
+    data_dicts can be any iterable (e.g. a streamed query); each order
+    vector is dropped once it is fingerprinted."""
+    cells, fingerprint_counts = [], {}
+    for idx, d in enumerate(tqdm(
+            data_dicts,
+            desc='Fingerprinting stimulus orders')):
+        cell_data = load_cell_meta(d)
+        stim = cell_data['stim_template'].item()
+        stim_table = load_data(
+            cell_data['stim_table'].item(),
+            allow_pkls=True)
+        fp = order_fingerprint(stim_table['stim_table'][:, 0])
+        cells += [(d, stim, fp)]
+
+        # Count fingerprints per stimulus; ties go to the first order seen
+        stim_counts = fingerprint_counts.setdefault(stim, {})
+        if fp not in stim_counts:
+            stim_counts[fp] = [0, -idx]
+        stim_counts[fp][0] += 1
+    if not len(cells):
+        return []
+    modal_fingerprints = {
+        stim: max(counts.iteritems(), key=lambda x: x[1])[0]
+        for stim, counts in fingerprint_counts.iteritems()}
+
+    # Keep cells with the modal order for their stimulus
+    filtered_data_dicts = [
+        d for d, stim, fp in cells
+        if fp == modal_fingerprints[stim]]
     print 'Filtered %s bad stimulus order cells (%s/%s remaining).' % (
-        len(data_dicts) - len(filtered_data_dicts),
+        len(cells) - len(filtered_data_dicts),
         len(filtered_data_dicts),
-        len(data_dicts))
+        len(cells))
     assert len(filtered_data_dicts) > 0,\
         'No data remaining after stimulus order filter.'
     return filtered_data_dicts
 
 
-def package_dataset(
-        config,
-        dataset_info,
-        output_directory,
-        check_stimuli=False):
-    """Query and package."""
+def query_cells(dataset_info):
+    """Query the DB for the cells described by dataset_info.
+
+    Returns a list, or an iterator of rows for queries that are streamed
+    (see inclusive_stim_order_filter)."""
     dataset_instructions = dataset_info['cross_ref']
     if dataset_instructions == 'rf_coordinate_range':
         # TODO fix this API so it doesn't rely on conditionals.
         data_dicts = data_db.get_cells_all_data_by_rf(
             dataset_info['rf_query'])[0]
     elif dataset_instructions == 'rf_coordinate_range_and_stimuli':
-        data_dicts = data_db.get_cells_all_data_by_rf_and_stimuli(
-            rfs=dataset_info['rf_query'],
+        # A lazy stream of plain dicts rather than every cursor row
+        return data_db.stream_cells_all_data_by_rf_and_stimuli(
+            rf=dataset_info['rf_query'][0],
             stimuli=dataset_info['stimuli'],
-            sessions=dataset_info['sessions'])[0]
+            sessions=dataset_info['sessions'])
     else:
         # Incorporate more queryies and eventually allow inner-joining on them.
         raise RuntimeError('Other instructions are not yet implemented.')
+    return [dict(d) for d in data_dicts]  # Plain dicts pickle cleanly
+
+
+def processing_params(dataset_info):
+    """Subset of dataset_info that changes how cell data is loaded."""
+    late_stage_keys = [
+        'experiment_name',
+        'dataset_name',
+        'cell_specimen_id',
+        'cc_data_dir',
+        'cv_split',
+        'store_means',
+        'tf_types',
+        'cc_repo_vars',
+        'cell_cache_dir',
+    ]
+    params = {
+        k: v for k, v in dataset_info.iteritems()
+        if k not in late_stage_keys}
+    params['multi_neuron'] = dataset_info[
+        'cc_repo_vars']['output_size'][0] > 0
+    return params
+
+
+def package_dataset(
+        config,
+        dataset_info,
+        output_directory,
+        check_stimuli=False,
+        manifest=None,
+        data_dicts=None):
+    """Query and package.
+
+    With a build_manifest, stages whose input hashes are unchanged reuse
+    their cached results or are skipped. data_dicts can hold an already
+    (e.g. prefetched) query_cells result for dataset_info."""
+    query_key = build_manifest.hash_inputs(
+        dataset_info['cross_ref'],
+        dataset_info['rf_query'],
+        get_field(dataset_info, 'stimuli', None),
+        get_field(dataset_info, 'sessions', None),
+        data_db.db_version())
+    prefiltered = False
+    if data_dicts is None and manifest is None:
+        # Filter streamed rows as they arrive instead of holding every
+        # cursor row and stimulus order at once
+        data_dicts = inclusive_stim_order_filter(query_cells(dataset_info))
+        prefiltered = True
+    elif data_dicts is None:
+        data_dicts = build_manifest.run_stage(
+            manifest,
+            'query',
+            query_key,
+            lambda: list(query_cells(dataset_info)),
+            ttl=config.db_query_cache_ttl)  # Pick up new cells in the DB
 
     if len(data_dicts) == 0:
         print 'No cells found in this query.'
         return False  # Unsucessful
 
-    # # Filter cells satisfying only one condition (could be a subquery).
-    # data_dicts = inclusive_cell_filter(
-    #     data_dicts=data_dicts,
-    #     sessions=dataset_info['sessions'])
+    # Load data (the stage key covers the query result and processing)
+    data_key = build_manifest.hash_inputs(
+        data_dicts,
+        processing_params(dataset_info))
 
-    # Filter cells that have odd stimulus orderings.
-    data_dicts = inclusive_stim_order_filter(data_dicts)
+    def load_stage():
+        # # Filter cells satisfying only one condition (could be a subquery).
+        # data_dicts = inclusive_cell_filter(
+        #     data_dicts=data_dicts,
+        #     sessions=dataset_info['sessions'])
 
-    # Load data
-    data_files, rf_dicts, cell_order = load_npzs(
-        data_dicts,
-        dataset_info,
-        stimuli_key=dataset_info['reference_image_key'],
-        neural_key=dataset_info['reference_label_key'],
-        check_stimuli=check_stimuli
-    )
+        # Filter cells that have odd stimulus orderings.
+        if prefiltered:
+            filtered_dicts = data_dicts
+        else:
+            filtered_dicts = inclusive_stim_order_filter(data_dicts)
+        return load_cell_data(
+            filtered_dicts,
+            dataset_info,
+            stimuli_key=dataset_info['reference_image_key'],
+            neural_key=dataset_info['reference_label_key'],
+            check_stimuli=check_stimuli)
+    output_data, rf_dicts, cell_order = build_manifest.run_stage(
+        manifest,
+        'load',
+        data_key,
+        load_stage)
+    data_files = package_events(
+        output_data=output_data,
+        exp_dict=dataset_info)
 
     # Prepare meta file to create a dataset specific data loader
     cc_repo = {
@@ -1182,14 +1401,18 @@ def package_dataset(
         stimuli_key=dataset_info['reference_image_key'],
         feature_types=dataset_info['tf_types'],
         cc_repo=cc_repo,
-        config=config)
+        config=config,
+        manifest=manifest,
+        data_key=data_key)
     return rf_dicts  # Successful
 
 
 def main(
         dataset,
         output_directory=None,
-        check_stimuli=False):
+        check_stimuli=False,
+        incremental=False,
+        data_dicts=None):
     """Pull desired experiment cells and encode as tfrecords."""
     assert dataset is not None, 'Name the experiment to process!'
     config = Config()
@@ -1203,11 +1426,21 @@ def main(
             config.tf_record_output)
     da['deconv_dir'] = config.deconv_model_dir
     helper_funcs.make_dir(output_directory)
+    if incremental:
+        manifest = build_manifest.build_manifest(
+            manifest_file=os.path.join(
+                output_directory,
+                '%s_manifest.json' % da['experiment_name']),
+            cache_dir=config.build_cache_dir)
+    else:
+        manifest = None
     return package_dataset(
         config=config,
         dataset_info=da,
         output_directory=output_directory,
-        check_stimuli=check_stimuli)
+        check_stimuli=check_stimuli,
+        manifest=manifest,
+        data_dicts=data_dicts)
     # TODO: Incorporate logger
 
 
@@ -1230,4 +1463,9 @@ if __name__ == '__main__':
         dest='check_stimuli',
         action='store_true',
         help='Check remaining stimuli before creating dataset.')
+    parser.add_argument(
+        '--incremental',
+        dest='incremental',
+        action='store_true',
+        help='Reuse cached stages whose inputs are unchanged.')
     main(**vars(parser.parse_args()))
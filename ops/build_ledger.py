@@ -0,0 +1,75 @@
+"""Checkpoint ledger for resumable dataset declaration runs."""
+import os
+import json
+import numpy as np
+
+
+# Build states, in order. Builds in a done state are skipped on resume.
+STATES = ['queued', 'encoding', 'encoded', 'registered', 'empty', 'failed']
+DONE_STATES = ['registered', 'empty']
+
+
+def to_json(x):
+    """json.dump fallback for numpy scalars and arrays."""
+    if isinstance(x, (np.generic, np.ndarray)):
+        return x.tolist()
+    raise TypeError('%s is not JSON serializable' % repr(x))
+
+
+class build_ledger(object):
+    """JSON record of every dataset build in a declaration run.
+
+    Each build is stored as {'state': state, 'job': encode kwargs,
+    'meta_dir': directory, ...}. The run's session name is kept so
+    resumed builds link to the same experiments."""
+
+    def __init__(self, ledger_file):
+        """Load an existing ledger if there is one."""
+        self.ledger_file = ledger_file
+        if os.path.exists(self.ledger_file):
+            with open(self.ledger_file, 'r') as f:
+                ledger = json.load(f)
+            self.session_name = ledger['session_name']
+            self.builds = ledger['builds']
+        else:
+            self.session_name = None
+            self.builds = []
+
+    def queue(self, session_name, builds):
+        """Record a new run's builds, all in the queued state."""
+        self.session_name = session_name
+        self.builds = [dict(b, state='queued') for b in builds]
+        self.save()
+
+    def update(self, idx, state, **info):
+        """Move a build to a new state, storing any extra info."""
+        assert state in STATES, 'Unknown build state: %s' % state
+        self.builds[idx].update(info)
+        self.builds[idx]['state'] = state
+        self.save()
+
+    def pending(self):
+        """Indices of builds that still need work."""
+        return [
+            idx for idx, b in enumerate(self.builds)
+            if b['state'] not in DONE_STATES]
+
+    def experiment_names(self):
+        """Experiment (method) names of the run's registered builds."""
+        return [
+            b['job']['method_name'] for b in self.builds
+            if b['state'] == 'registered']
+
+    def save(self):
+        """Atomically write the ledger to disk."""
+        tmp_file = '%s.tmp' % self.ledger_file
+        with open(tmp_file, 'w') as f:
+            json.dump(
+                {
+                    'session_name': self.session_name,
+                    'builds': self.builds
+                },
+                f,
+                indent=2,
+                default=to_json)
+        os.rename(tmp_file, self.ledger_file)
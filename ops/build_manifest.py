@@ -0,0 +1,122 @@
+"""Content-hash manifest for incremental dataset rebuilds."""
+import os
+import json
+import time
+import hashlib
+import numpy as np
+from ops import helper_funcs
+
+
+def update_hash(digest, x):
+    """Recursively feed python/numpy data into a hashlib digest."""
+    if isinstance(x, dict):
+        digest.update('{')
+        for k in sorted(x.keys(), key=repr):
+            update_hash(digest, k)
+            update_hash(digest, x[k])
+        digest.update('}')
+    elif isinstance(x, (list, tuple)):
+        digest.update('[')
+        for v in x:
+            update_hash(digest, v)
+        digest.update(']')
+    elif isinstance(x, np.ndarray):
+        digest.update('%s%s' % (x.dtype, x.shape))
+        if x.dtype == object:
+            update_hash(digest, x.tolist())
+        else:
+            digest.update(np.ascontiguousarray(x).tostring())
+    elif isinstance(x, type):
+        digest.update(x.__name__)
+    else:
+        digest.update(repr(x))
+
+
+def hash_inputs(*args):
+    """Return an md5 hexdigest of all arguments."""
+    digest = hashlib.md5()
+    for x in args:
+        update_hash(digest, x)
+    return digest.hexdigest()
+
+
+def run_stage(manifest, stage, key, fn, ttl=None):
+    """Return fn(), reusing a cached result if the manifest has one.
+
+    With a ttl (seconds), cached results older than that are recomputed."""
+    if manifest is None:
+        return fn()
+    out = manifest.load_cached(stage, key, ttl)
+    if out is None:
+        out = fn()
+        manifest.save_cached(stage, key, out)
+    else:
+        print 'Reusing cached %s stage (%s).' % (stage, key)
+    return out
+
+
+class build_manifest(object):
+    """Record stage input hashes and outputs for one dataset build.
+
+    Each stage is stored as {'key': input hash, 'outputs': [files]}.
+    A stage is unchanged if its key matches and its outputs exist.
+    Intermediate results are pickled to cache_dir by stage and key.
+    """
+
+    def __init__(self, manifest_file, cache_dir):
+        """Load an existing manifest if there is one."""
+        self.manifest_file = manifest_file
+        self.cache_dir = cache_dir
+        helper_funcs.make_dir(self.cache_dir)
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r') as f:
+                self.stages = json.load(f)['stages']
+        else:
+            self.stages = {}
+
+    def unchanged(self, stage, key):
+        """Check if a stage's inputs and outputs are still current."""
+        if stage not in self.stages:
+            return False
+        if self.stages[stage]['key'] != key:
+            return False
+        return all(os.path.exists(f) for f in self.stages[stage]['outputs'])
+
+    def record(self, stage, key, outputs=()):
+        """Store a stage's input hash and output files."""
+        self.stages[stage] = {
+            'key': key,
+            'outputs': list(outputs)
+        }
+        self.save()
+
+    def save(self):
+        """Atomically write the manifest to disk."""
+        tmp_file = '%s.tmp' % self.manifest_file
+        with open(tmp_file, 'w') as f:
+            json.dump({'stages': self.stages}, f, indent=2, sort_keys=True)
+        os.rename(tmp_file, self.manifest_file)
+
+    def cache_file(self, stage, key):
+        """Path for a stage's pickled intermediate result."""
+        return os.path.join(self.cache_dir, '%s_%s.pkl' % (stage, key))
+
+    def load_cached(self, stage, key, ttl=None):
+        """Load an intermediate result, or None if it is not cached (or
+        it is older than ttl seconds)."""
+        cache_file = self.cache_file(stage, key)
+        if not os.path.exists(cache_file):
+            return None
+        if ttl is not None and time.time() - os.path.getmtime(
+                cache_file) > ttl:
+            print 'Cached %s stage (%s) has expired.' % (stage, key)
+            return None
+        return helper_funcs.load_object(cache_file)
+
+    def save_cached(self, stage, key, obj):
+        """Pickle an intermediate result and record it in the manifest."""
+        cache_file = self.cache_file(stage, key)
+        tmp_file = '%s.tmp' % cache_file
+        helper_funcs.save_object(obj, tmp_file)
+        os.rename(tmp_file, cache_file)
+        self.record(stage, key, [cache_file])
@@ -0,0 +1,73 @@
+"""Run-scoped cache of processed cell data shared across dataset builds."""
+import os
+import shutil
+import numpy as np
+from ops import helper_funcs
+
+
+class cell_cache(object):
+    """Processed per-cell dicts and stimuli stored as .npy files.
+
+    Each cell entry is a directory holding one .npy per array field and a
+    pickle of the remaining fields. Arrays are memory-mapped read-only on
+    load so builds (and worker processes) share pages instead of copies.
+    Entries are written to a temporary path and renamed into place, so
+    concurrent builds never see a partial entry.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.stimulus_dir = os.path.join(cache_dir, 'stimuli')
+        helper_funcs.make_dir(self.cache_dir)
+        helper_funcs.make_dir(self.stimulus_dir)
+
+    def tmp_path(self, path):
+        """Per-process temporary path for an entry."""
+        return '%s.%s.tmp' % (path, os.getpid())
+
+    def load_cell(self, key):
+        """Load a processed cell dict, or None if it is not cached."""
+        entry_dir = os.path.join(self.cache_dir, key)
+        if not os.path.exists(entry_dir):
+            return None
+        df = helper_funcs.load_object(os.path.join(entry_dir, 'fields.pkl'))
+        for k in df.pop('array_fields'):
+            df[k] = np.load(
+                os.path.join(entry_dir, '%s.npy' % k),
+                mmap_mode='r')
+        return df
+
+    def save_cell(self, key, df):
+        """Store a processed cell dict and return its memory-mapped copy."""
+        entry_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = self.tmp_path(entry_dir)
+        helper_funcs.make_dir(tmp_dir)
+        fields = {
+            k: v for k, v in df.iteritems()
+            if not isinstance(v, np.ndarray) or v.dtype == object}
+        fields['array_fields'] = [k for k in df.keys() if k not in fields]
+        for k in fields['array_fields']:
+            np.save(os.path.join(tmp_dir, '%s.npy' % k), df[k])
+        helper_funcs.save_object(fields, os.path.join(tmp_dir, 'fields.pkl'))
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another build stored this cell first
+            shutil.rmtree(tmp_dir)
+        return self.load_cell(key)
+
+    def load_stimulus(self, key):
+        """Memory-map processed stimuli, or None if they are not cached."""
+        stim_file = os.path.join(self.stimulus_dir, '%s.npy' % key)
+        if not os.path.exists(stim_file):
+            return None
+        return np.load(stim_file, mmap_mode='r')
+
+    def save_stimulus(self, key, stimuli):
+        """Store processed stimuli and return their memory-mapped copy."""
+        stim_file = os.path.join(self.stimulus_dir, '%s.npy' % key)
+        tmp_file = self.tmp_path(stim_file)
+        with open(tmp_file, 'wb') as f:
+            np.save(f, np.asarray(stimuli))
+        os.rename(tmp_file, stim_file)
+        return self.load_stimulus(key)
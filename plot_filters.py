@@ -50,9 +50,10 @@ def plot_fits(
     template_exp: The name of the contextual_circuit model template used."""
 
     if process_pnodes:
-        from pnodes_declare_datasets_loop import query_hp_hist, sel_exp_query
+        from pnodes_declare_datasets_loop import query_performance,\
+            sel_exps_query
     else:
-        from declare_datasets_loop import query_hp_hist, sel_exp_query
+        from declare_datasets_loop import query_performance, sel_exps_query
 
     main_config = Allen_Brain_Observatory_Config()
     sys.path.remove('/usr/local/lib/python2.7/dist-packages/Contextual_DCN-0.1-py2.7.egg')
@@ -62,7 +63,7 @@ def plot_fits(
     sys.path.append(os.path.join(main_config.cc_path, 'db'))
     sys.path.append(os.path.join(main_config.cc_path))
     import ipdb;ipdb.set_trace()
-    db_config = credentials.postgresql_connection()
+    from db import credentials
     files = glob(
         os.path.join(
             main_config.multi_exps,
@@ -70,6 +71,7 @@ def plot_fits(
     out_data, xs, ys = [], [], []
     perfs, model_types, exps, arg_perf = [], [], [], []
     count = 0
+    datasets = []
     for f in files:
         data = np.load(f)
         d = {
@@ -81,20 +83,33 @@ def plot_fits(
         exp_name = {
             'experiment_name': data['dataset_method'].item()[
                 'experiment_name']}
+        datasets += [(d, exp_name)]
+    if query_db:
+        # Summarize every experiment's performance in one query
+        perf_table = query_performance(
+            credentials=credentials,
+            experiment_names=[e['experiment_name'] for _, e in datasets])
+    for d, exp_name in datasets:
         if query_db:
-            perf = query_hp_hist(
-                exp_name['experiment_name'],
-                db_config=db_config)
-            if perf is None:
+            perf = perf_table[
+                perf_table['experiment_name'] == exp_name['experiment_name']]
+            if not len(perf):
                 print 'No fits for: %s' % exp_name['experiment_name']
-            else:
-                raise NotImplementedError
-                d['perf'] = perf
-                d['max_val'] = np.max(perf)
-                out_data += [d]
+            for row in perf:
+                # validation_loss holds the pearson score (higher is
+                # better), as in the val_losses.npy branch below
+                mt = row['model_struct'].split(os.path.sep)[-1]
+                it_d = dict(d)
+                it_d['perf'] = row['max_validation_loss']
+                it_d['max_val'] = row['max_validation_loss']
+                it_d['mt'] = mt
+                out_data += [it_d]
                 xs += [np.round(d['x'])]
                 ys += [np.round(d['y'])]
-                perfs += [np.max(d['perf'])]
+                perfs += [row['max_validation_loss']]
+                arg_perf += [-1]  # Best step is not summarized
+                exps += [exp_name['experiment_name']]
+                model_types += [mt]
                 count += 1
         else:
             data_files = glob(
@@ -166,11 +181,12 @@ def plot_fits(
     it_exps = exps[model_types == target_layer]
     # it_args = arg_perf[model_types == target_layer]
     sorted_perfs = np.argsort(it_perfs)[::-1][:top_n]
+    exp_perfs = sel_exps_query(
+        experiment_names=it_exps[sorted_perfs].tolist(),
+        model=target_layer,
+        credentials=credentials)
     for idx in sorted_perfs:
-        perf = sel_exp_query(
-            experiment_name=it_exps[idx],
-            model=target_layer,
-            db_config=db_config)
+        perf = exp_perfs[it_exps[idx]]
         # perf_steps = np.argsort([v['training_step'] for v in perf])[::-1]
         perf_steps = [v['validation_loss'] for v in perf]
         max_score = np.max(perf_steps)
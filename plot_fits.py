@@ -4,7 +4,7 @@ import argparse
 import numpy as np
 from glob import glob
 from allen_config import Allen_Brain_Observatory_Config
-from declare_datasets_loop import query_hp_hist
+from declare_datasets_loop import query_performance
 from matplotlib import pyplot as plt
 import pandas as pd
 # from ggplot import *
@@ -77,6 +77,7 @@ def plot_fits(
             experiment, '*.npz'))
     out_data, xs, ys, perfs, model_types = [], [], [], [], []
     count = 0
+    datasets = []
     for f in files:
         data = np.load(f)
         d = {
@@ -88,20 +89,30 @@ def plot_fits(
         exp_name = {
             'experiment_name': data['dataset_method'].item()[
                 'experiment_name']}
-        import ipdb; ipdb.set_trace()
+        datasets += [(d, exp_name)]
+    if query_db:
+        # Summarize every experiment's performance in one query
+        perf_table = query_performance(
+            credentials=credentials,
+            experiment_names=[e['experiment_name'] for _, e in datasets])
+    for d, exp_name in datasets:
         if query_db:
-            perf = query_hp_hist(exp_name['experiment_name'], credentials=credentials)
-            import ipdb; ipdb.set_trace()
-            if perf is None:
+            perf = perf_table[
+                perf_table['experiment_name'] == exp_name['experiment_name']]
+            if not len(perf):
                 print 'No fits for: %s' % exp_name['experiment_name']
-            else:
-                d['perf'] = perf
-                d['max_val'] = np.max(perf)
-                # d['mt'] = mt
-                out_data += [d]
+            for row in perf:
+                # validation_loss holds the pearson score (higher is
+                # better), as in the val_losses.npy branch below
+                mt = row['model_struct'].split(os.path.sep)[-1]
+                it_d = dict(d)
+                it_d['perf'] = row['max_validation_loss']
+                it_d['max_val'] = row['max_validation_loss']
+                it_d['mt'] = mt
+                out_data += [it_d]
                 xs += [np.round(d['x'])]
                 ys += [np.round(d['y'])]
-                perfs += [np.max(d['perf'])]
+                perfs += [row['max_validation_loss']]
                 model_types += [mt]
                 count += 1
         else:
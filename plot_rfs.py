@@ -6,7 +6,7 @@ from allen_config import Allen_Brain_Observatory_Config
 import numpy as np
 from data_db import data_db
 import argparse
-import matplotlib.patches as mpatches
+from matplotlib.collections import EllipseCollection
 from tqdm import tqdm
 
 
@@ -80,10 +80,13 @@ def main(
             all_data_dicts += [data_db.get_cells_all_data_by_rf_and_stimuli(
                 rfs=q,
                 stimuli=filter_by_stim,
-                sessions=sessions)]
+                sessions=sessions,
+                columnar=True)]
     else:
         print 'Pulling cells by their RFs.'
-        all_data_dicts = data_db.get_cells_all_data_by_rf(queries)
+        all_data_dicts = data_db.get_cells_all_data_by_rf(
+            queries,
+            columnar=True)
 
     # Make sure there are no null RFs
     visual_space_h = np.floor(main_config.LSN_size_in_deg['height'])
@@ -96,15 +99,19 @@ def main(
                 total=len(all_data_dicts),
                 desc='Plotting cell heatmap'):
 
+            cells = data_dicts[0]
             canvas = np.zeros((int(visual_space_h), int(visual_space_w)))
-            for dat in data_dicts[0]:
-                try:
-                    canvas[int(dat['on_center_y']), int(dat['on_center_x'])] += 1
-                except:
-                    import ipdb;ipdb.set_trace()
+            found = np.isfinite(cells['on_center_y']) & np.isfinite(
+                cells['on_center_x'])
+            ys = cells['on_center_y'][found].astype(int)
+            xs = cells['on_center_x'][found].astype(int)
+            # Negative indices would wrap to the opposite edge
+            on_canvas = (ys >= 0) & (ys < canvas.shape[0]) & (
+                xs >= 0) & (xs < canvas.shape[1])
+            np.add.at(canvas, (ys[on_canvas], xs[on_canvas]), 1)
             canvas = cv2.GaussianBlur(canvas, kernel, 0)
             f = plt.figure()
-            plt.title('%s %s cells' % (label, len(data_dicts[0])))
+            plt.title('%s %s cells' % (label, len(cells['cell_specimen_id'])))
             plt.imshow(canvas)
             plt.show()
             plt.close(f)
@@ -115,12 +122,12 @@ def main(
                 query_labels),
             total=len(all_data_dicts),
             desc='Plotting cell centroids'):
+        cells = data_dicts[0]
         fig = plt.figure()
-        for dat in data_dicts[0]:
-            plt.scatter(dat['on_center_y'], dat['on_center_x'])
+        plt.scatter(cells['on_center_y'], cells['on_center_x'])
         plt.xlim(0, visual_space_w)
         plt.ylim(0, visual_space_h)
-        plt.title('%s %s cells' % (label, len(data_dicts[0])))
+        plt.title('%s %s cells' % (label, len(cells['cell_specimen_id'])))
         plt.show()
 
     for data_dicts, label in tqdm(
@@ -129,25 +136,24 @@ def main(
                 query_labels),
             total=len(all_data_dicts),
             desc='Plotting cell elipsoids'):
+        cells = data_dicts[0]
         fig, ax = plt.subplots()
         ax.set_xlim(0, visual_space_w)
         ax.set_ylim(0, visual_space_h)
-        for dat in data_dicts[0]:
-            xy = (dat['on_center_y'], dat['on_center_x'])
-            width = 3 * np.abs(dat['on_width_y'])
-            height = 3 * np.abs(dat['on_width_x'])
-            angle = dat['on_rotation']
-            if np.logical_not(any(np.isnan(xy))):
-                ellipse = mpatches.Ellipse(
-                    xy,
-                    width=width,
-                    height=height,
-                    angle=angle,
-                    lw=2,
-                    edgecolor=color,
-                    facecolor=color,
-                    alpha=0.1)
-                ax.add_artist(ellipse)
+        xy = np.column_stack((cells['on_center_y'], cells['on_center_x']))
+        found = np.logical_not(np.any(np.isnan(xy), axis=1))
+        ellipses = EllipseCollection(
+            widths=3 * np.abs(cells['on_width_y'][found]),
+            heights=3 * np.abs(cells['on_width_x'][found]),
+            angles=cells['on_rotation'][found],
+            units='xy',
+            offsets=xy[found],
+            transOffset=ax.transData,
+            linewidths=2,
+            edgecolors=color,
+            facecolors=color,
+            alpha=0.1)
+        ax.add_collection(ellipses)
         plt.xlim(0, visual_space_w)
         plt.ylim(0, visual_space_h)
         plt.title(label)